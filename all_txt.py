@@ -0,0 +1,294 @@
+############################################################################################
+#
+# all_txt.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Routines to read decodes from wsjt ALL.TXT files.
+#
+# Notes:
+# - We keep track of the byte offset of the last complete line we've read so
+#   that we can pick up where we left off when the file grows.
+# - Large files are split into chunks on line boundaries which can be read
+#   in parallel by a process pool.
+# - Only the newer (WSJT-X 2.x) format is supported, e.g.
+#      210503_123015    14.074 Rx FT8    -12  0.2 1234 CQ K1ABC FN42
+# - If the station sends its grid square, e.g. in a CQ or a reply like
+#   K1ABC W9XYZ EN37, we keep it along with the spot as a grid code (see
+#   maidenhead.py).  -1 means there wasn't one.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import os
+import re
+import numpy as np
+from datetime import datetime
+from spot_store import intern, freqs2codes, fix_band_switches
+from maidenhead import grid2code
+
+############################################################################################
+
+# Number of bytes at the start of a file we use to tell if it has been replaced
+HEAD_SIZE=128
+
+# Size of chunks we break big files into for parallel reading
+CHUNK_SIZE=4*1024*1024
+
+# Max number of lines we handle at once in each stage of the pipeline
+BATCH_SIZE=50000
+
+# A call has to have at least one letter and one digit in it
+CALL_RE = re.compile('^(?=.*[0-9])(?=.*[A-Z])[A-Z0-9/]{3,12}$')
+
+############################################################################################
+
+# Function to find where the call of the station that sent a message is
+def msg2sender(msg):
+
+    if len(msg)<2:
+        return None
+
+    if msg[0] in ['CQ','QRZ']:
+        # Skip over directed CQs - e.g. CQ DX K1ABC FN42 or CQ 123 K1ABC FN42
+        i=1
+        if len(msg)>2 and not CALL_RE.match(msg[1].strip('<>')):
+            i=2
+    else:
+        i=1
+
+    if CALL_RE.match(msg[i].strip('<>')):
+        return i
+    else:
+        return None
+
+# Function to pull the grid square the sender sent - it follows the call -
+# returns its code or -1
+def msg2grid(msg,i):
+    if i+1<len(msg):
+        return grid2code(msg[i+1])
+    else:
+        return -1
+
+# Function to parse a single line - returns (time stamp, freq in KHz, snr,
+# call, grid code) or None
+def parse_line(line):
+
+    toks = line.split()
+    if len(toks)<9 or toks[2]!='Rx' or len(toks[0])!=13 or toks[0][6]!='_':
+        return None
+
+    try:
+        s = toks[0]
+        ts = datetime(2000+int(s[0:2]),int(s[2:4]),int(s[4:6]),
+                      int(s[7:9]),int(s[9:11]),int(s[11:13]))
+        freq = 1000.*float(toks[1]) + .001*int(toks[6])
+        snr = int(toks[4])
+    except ValueError:
+        return None
+
+    msg = toks[7:]
+    i = msg2sender(msg)
+    if i is None:
+        return None
+    return ts,freq,snr,msg[i].strip('<>'),msg2grid(msg,i)
+
+############################################################################################
+
+# Function to grab info we need to tell if a file has changed since we last read it
+def file_state(fname):
+    st = os.stat(fname)
+    with open(fname,'rb') as fp:
+        head = fp.read(HEAD_SIZE)
+    return {'size'  : st.st_size,
+            'mtime' : st.st_mtime,
+            'head'  : head.decode('latin-1')}
+
+# Function to break a file into chunks of about chunk_size bytes, starting
+# at offset and stopping at end (a line boundary), if given.  Chunks always
+# end on a line boundary.
+def split_file(fname,offset=0,end=None,chunk_size=CHUNK_SIZE):
+
+    if end is None:
+        size = os.path.getsize(fname)
+    else:
+        size = end
+    chunks=[]
+    with open(fname,'rb') as fp:
+        start=offset
+        while start<size:
+            end=start+chunk_size
+            if end<size:
+                fp.seek(end)
+                fp.readline()
+                end=min(fp.tell(),size)
+            else:
+                end=size
+            chunks.append( (start,end) )
+            start=end
+
+    return chunks
+
+############################################################################################
+#
+# Spots are read through a pipeline of generators, each handling a batch of
+# at most BATCH_SIZE lines at a time:
+#
+#   read_lines -> parse_batches -> filter_batches -> band_batches
+#
+# A batch of parsed spots is a tuple of columns (ts,freq,snr,call,grid,calls)
+# where call indexes into the list of calls seen in that batch.  Each
+# stage also passes along the file offset just past the batch.
+#
+############################################################################################
+
+# Function to read complete lines from a file in batches, from byte offset
+# start up to end (or the end of the file if end is None)
+def read_lines(fname,start=0,end=None,batch_size=BATCH_SIZE):
+
+    lines=[]
+    offset=start
+    with open(fname,'rb') as fp:
+        fp.seek(start)
+        for line in fp:
+
+            # A partial line means wsjt is still writing it - we'll get it next time
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            lines.append(line)
+
+            if len(lines)>=batch_size:
+                yield lines,offset
+                lines=[]
+            if end is not None and offset>=end:
+                break
+
+    if len(lines)>0:
+        yield lines,offset
+
+# Function to parse batches of lines into spot columns
+def parse_batches(batches):
+
+    for lines,offset in batches:
+        ts=[]
+        freqs=[]
+        snrs=[]
+        call=[]
+        grids=[]
+        calls=[]
+        codes={}
+        for line in lines:
+            spot = parse_line( line.decode('utf-8',errors='replace') )
+            if spot:
+                ts.append(spot[0])
+                freqs.append(spot[1])
+                snrs.append(spot[2])
+                call.append( intern(calls,codes,spot[3]) )
+                grids.append(spot[4])
+
+        yield (np.array(ts,dtype='datetime64[s]'),
+               np.array(freqs,dtype=np.float64),
+               np.array(snrs,dtype=np.int16),
+               np.array(call,dtype=np.int32),
+               np.array(grids,dtype=np.int16),
+               calls),offset
+
+# Function to drop spots older than cutoff.  Older spots that came with a
+# grid are kept so the grids carried over to later spots are the same as if
+# we had read them as they came in - DxccResolver.enrich() drops them.
+def filter_batches(batches,cutoff=None):
+
+    for cols,offset in batches:
+        if cutoff is not None:
+            keep = (cols[0] >= np.datetime64(cutoff,'s')) | (cols[4]>=0)
+            if not np.all(keep):
+                cols = take_batch(cols,keep)
+        yield cols,offset
+
+# Function to classify spots into bands and correct band switches while
+# decoding.  The last time stamp and band code carry over from one batch to
+# the next so this has to see the batches in file order.  Yields
+# (ts,band,snr,call,grid,calls) batches.
+def band_batches(batches,last_ts=None,last_code=None):
+
+    for (ts,freq,snr,call,grid,calls),offset in batches:
+        codes = fix_band_switches(ts,freqs2codes(freq),last_ts,last_code)
+        if len(ts)>0:
+            last_ts   = ts[-1]
+            last_code = codes[-1]
+        yield (ts,codes,snr,call,grid,calls),offset
+
+# Function to select rows from a batch, dropping calls that are no longer used
+def take_batch(cols,idx):
+    ts,freq,snr,call,grid,calls = cols
+    used,call = np.unique(call[idx],return_inverse=True)
+    return ts[idx],freq[idx],snr[idx],call.astype(np.int32),grid[idx],[calls[i] for i in used]
+
+# Function to join batches into one
+def join_batches(batches):
+
+    ts=[]
+    freqs=[]
+    snrs=[]
+    call=[]
+    grids=[]
+    calls=[]
+    codes={}
+    for b in batches:
+        call_map = np.array([intern(calls,codes,c) for c in b[5]],dtype=np.int32)
+        ts.append(b[0])
+        freqs.append(b[1])
+        snrs.append(b[2])
+        call.append(call_map[b[3]])
+        grids.append(b[4])
+
+    if len(ts)==0:
+        return (np.array([],dtype='datetime64[s]'),np.array([],dtype=np.float64),
+                np.array([],dtype=np.int16),np.array([],dtype=np.int32),
+                np.array([],dtype=np.int16),[])
+    return (np.concatenate(ts),np.concatenate(freqs),np.concatenate(snrs),
+            np.concatenate(call),np.concatenate(grids),calls)
+
+############################################################################################
+
+# Function to read spots from a chunk of a file - this is what runs in the
+# worker processes.  Returns a single batch for the whole chunk and the
+# offset just past the last complete line.
+def read_chunk(fname,start=0,end=None,cutoff=None):
+
+    batches=[]
+    offset=start
+    for cols,offset in filter_batches(parse_batches(read_lines(fname,start,end)),cutoff):
+        batches.append(cols)
+    return join_batches(batches),offset
+
+# Function to start reading spots from a file starting at a particular byte
+# offset, up to end if given.  The spots are streamed in batches as they
+# are read.
+def start_read(fname,offset=0,cutoff=None,end=None):
+    return filter_batches(parse_batches(read_lines(fname,offset,end)),cutoff)
+
+# Function to read a list of (fname,start,end) chunks with a pool of
+# processes.  Yields the batch for each chunk in order.  Only a few more
+# than we're using are kept on the go so finished chunks don't pile up
+# waiting for us - that way the memory used doesn't depend on how much
+# there is to read.
+def read_chunks(pool,chunks,cutoff=None,ahead=4):
+    jobs=[]
+    for fname,start,end in chunks:
+        jobs.append( pool.submit(read_chunk,fname,start,end,cutoff) )
+        if len(jobs)>ahead:
+            yield jobs.pop(0).result()
+    while len(jobs)>0:
+        yield jobs.pop(0).result()
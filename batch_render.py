@@ -0,0 +1,166 @@
+############################################################################################
+#
+# batch_render.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Headless rendering of spot maps - one frame per time window - for making
+# propagation animations on a machine without a display.
+#
+# Notes:
+# - Frames are drawn with the Agg canvas so there is no need for Qt.  The
+#   drawing is the same as the gui - cached background, night shading and
+#   a scatter for each band.
+# - The background is rendered (if need be) before the pool is started so
+#   the workers all just read the same cached image.
+# - The frames are saved as numbered PNGs.  If the output is a .gif they are
+#   put together with Pillow and if it is an .mp4, with ffmpeg.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from map_background import CylMap, EXTENT, background_file, render_background
+from spot_cube import SpotCube
+from spot_window import BANDS, ALPHA, SPOTS, prepare_window, create_scatters, update_scatters
+
+############################################################################################
+
+WIDTH=1200                   # Frame size in pixels
+HEIGHT=650
+DPI=100
+SCALE=0.01                   # Relief scale for the background
+
+############################################################################################
+
+# Class to draw frames on an offscreen canvas
+class FrameRenderer:
+
+    def __init__(self,spots,bands=BANDS,width=WIDTH,height=HEIGHT,mode=SPOTS):
+        self.spots = spots
+        self.cube  = SpotCube(spots)
+        self.bands = bands
+        self.mode  = mode
+
+        self.fig = Figure(figsize=(width/DPI,height/DPI),dpi=DPI)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0,0,1,0.94])
+        self.m = CylMap(self.ax)
+        self.m.draw_background(SCALE,width,height,ALPHA)
+        self.lines = create_scatters(self.m,self.ax,bands)
+        self.title = self.fig.text(0.5,0.97,'',ha='center',va='center',fontsize='medium')
+
+    # Function to draw the spots for a window and save the frame
+    def render(self,date1,date2,Need,fname):
+        data = prepare_window(self.spots,self.cube,date1,date2,Need,self.m,
+                              bands=self.bands,mode=self.mode)
+        self.m.nightshade(date1,alpha=0.2)
+        update_scatters(self.lines,data)
+
+        fmt = "%m/%d %H:%M"
+        self.title.set_text('%s - %s UTC   %s   %d Spots   %d DXCCs   %d Slots' % \
+                            (date1.strftime(fmt),date2.strftime(fmt),Need,
+                             data.nspots,data.ndxcc,data.nslots))
+        self.fig.savefig(fname,dpi=DPI)
+        return fname
+
+############################################################################################
+
+# Each worker process has its own renderer
+renderer=None
+
+def init_worker(spots,bands,width,height,mode):
+    global renderer
+    renderer = FrameRenderer(spots,bands,width,height,mode)
+
+def render_frame(date1,date2,Need,fname):
+    return renderer.render(date1,date2,Need,fname)
+
+############################################################################################
+
+# Function to render a frame for each time step from date1 to date2.  out is
+# either a directory for the PNGs or a .gif or .mp4 file.
+def render_frames(spots,date1,date2,dT,Need,out,bands=BANDS,
+                  width=WIDTH,height=HEIGHT,fps=4,nworkers=None,mode=SPOTS):
+
+    dates=[]
+    date=date1
+    while date<date2:
+        dates.append(date)
+        date += timedelta(hours=dT)
+    print('Rendering',len(dates),'frames from',date1,'to',date2,'...')
+
+    # Don't bother rendering anything if we can't make the movie
+    ext = os.path.splitext(out)[1].lower()
+    if ext=='.mp4' and not shutil.which('ffmpeg'):
+        print('Need ffmpeg to make',out,'- try a .gif instead')
+        sys.exit(1)
+
+    if ext in ['.gif','.mp4']:
+        frame_dir = tempfile.mkdtemp(prefix='wsmap_')
+    else:
+        frame_dir = out
+        os.makedirs(frame_dir,exist_ok=True)
+    fnames = [os.path.join(frame_dir,'frame_%4.4d.png' % i) for i in range(len(dates))]
+
+    # The temporary frames are cleaned up even if something goes wrong
+    try:
+        # Make sure the background is in the cache before the workers need it
+        fname = background_file('cyl',EXTENT,SCALE,width,height)
+        if not os.path.exists(fname):
+            render_background(fname,EXTENT,SCALE,width,height,ALPHA)
+
+        if nworkers==1:
+            init_worker(spots,bands,width,height,mode)
+            for date,fname in zip(dates,fnames):
+                render_frame(date,date+timedelta(hours=dT),Need,fname)
+        else:
+            with ProcessPoolExecutor(max_workers=nworkers,initializer=init_worker,
+                                     initargs=(spots,bands,width,height,mode)) as pool:
+                jobs = [pool.submit(render_frame,date,date+timedelta(hours=dT),Need,fname)
+                        for date,fname in zip(dates,fnames)]
+                for job in jobs:
+                    print('... Rendered',job.result())
+
+        if ext=='.gif':
+            make_gif(fnames,out,fps)
+        elif ext=='.mp4':
+            make_mp4(frame_dir,out,fps)
+    finally:
+        if frame_dir!=out:
+            shutil.rmtree(frame_dir)
+    print('... Rendered',len(dates),'frames to',out)
+
+
+# Function to put the frames together into an animated gif
+def make_gif(fnames,out,fps):
+    from PIL import Image
+    frames = [Image.open(fname).convert('RGB') for fname in fnames]
+    if len(frames)>0:
+        frames[0].save(out,save_all=True,append_images=frames[1:],
+                       duration=int(1000/fps),loop=0)
+
+# Function to put the frames together into a movie
+def make_mp4(frame_dir,out,fps):
+    subprocess.run(['ffmpeg','-y','-loglevel','error','-framerate',str(fps),
+                    '-i',os.path.join(frame_dir,'frame_%04d.png'),
+                    '-pix_fmt','yuv420p','-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2',out],
+                   check=True)
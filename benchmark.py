@@ -0,0 +1,335 @@
+#! /usr/bin/python3 -u
+############################################################################################
+#
+# benchmark.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Benchmarks for reading spots and drawing maps, run on synthetic ALL.TXT
+# files so the results can be reproduced.
+#
+# Notes:
+# - The synthetic logs have a configurable number of days, decode rate, band
+#   mix and callsign popularity (Zipf distributed so a few stations show up
+#   a lot and most only a few times - like real life).
+# - Each stage is timed a few times and the best time is reported along with
+#   the throughput.  Peak memory is measured in a separate run under
+#   tracemalloc so it doesn't slow down the timing.
+# - Results can be saved as a baseline in a json file and later runs are
+#   compared against it.  Anything slower than the tolerance is flagged.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import sys
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+from datetime import datetime, timedelta
+
+from all_txt import read_lines, parse_batches, band_batches
+from spot_store import SpotBuilder
+from spot_window import BANDS, filter_spots, count_dxccs
+
+############################################################################################
+
+# Dial freqs (MHz) for FT8 on each band
+DIAL_FREQS={'160m':1.840, '80m':3.573, '40m':7.074, '30m':10.136, '20m':14.074,
+            '17m':18.100, '15m':21.074, '12m':24.915, '10m':28.074, '6m':50.313}
+
+# Default band mix - fraction of the time spent on each band
+BAND_MIX={'160m':.03, '80m':.10, '40m':.20, '30m':.12, '20m':.25,
+          '17m':.10, '15m':.08, '12m':.04, '10m':.06, '6m':.02}
+
+# Prefixes for made up calls - spread over lots of countries
+PREFIXES=['K','W','N','AA','KH6','KL7','VE','XE','CO','KP4','HI','YV','HK','PY','LU','CE',
+          'OA','HC','G','GM','EI','F','EA','CT','I','DL','OE','HB9','PA','ON','OZ','SM',
+          'LA','OH','SP','OK','HA','YO','LZ','SV','UA','UR','4X','SU','CN','ZS','5Z','9J',
+          'A6','VU','JA','HL','BY','BV','DU','YB','9M','HS','VK','ZL','KH2','FK','3D2']
+
+BASELINE_FILE='benchmark.json'
+TOLERANCE=0.2
+
+############################################################################################
+
+# Function to make up a list of calls
+def make_calls(ncalls,rng):
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    calls=set()
+    while len(calls)<ncalls:
+        pfx    = PREFIXES[rng.integers(len(PREFIXES))]
+        digit  = str(rng.integers(10))
+        suffix = ''.join(rng.choice(letters,rng.integers(1,4)))
+        calls.add(pfx+digit+suffix)
+    return sorted(calls)
+
+# Function to write a synthetic ALL.TXT file.  rate is the average number of
+# decodes per minute and zipf sets how lopsided the call popularity is.
+def make_all_txt(fname,date1,days=1,rate=100,band_mix=BAND_MIX,ncalls=5000,
+                 zipf=1.2,mycall='AA2IL',seed=0):
+
+    rng   = np.random.default_rng(seed)
+    calls = make_calls(ncalls,rng)
+    bands = list(band_mix.keys())
+    prob  = np.array([band_mix[b] for b in bands])
+    prob /= prob.sum()
+
+    # Call popularity - rank k is picked with prob ~ 1/k^zipf
+    weights = 1./np.arange(1,ncalls+1)**zipf
+    weights /= weights.sum()
+
+    # FT8 cycles are 15 sec - we stay on a band for an hour at a time
+    ncycles = int(days*24*60*4)
+    per_hour = 4*60
+    hour_band = rng.choice(len(bands),int(np.ceil(ncycles/per_hour)),p=prob)
+    ndecodes = rng.poisson(rate/4.,ncycles)
+
+    nlines=0
+    with open(fname,'w') as fp:
+        for cycle in range(ncycles):
+            n = ndecodes[cycle]
+            if n==0:
+                continue
+            date = date1 + timedelta(seconds=15*cycle)
+            t    = date.strftime('%y%m%d_%H%M%S')
+            band = bands[hour_band[cycle//per_hour]]
+            dial = DIAL_FREQS[band]
+            who  = rng.choice(ncalls,n,p=weights)
+            snrs = rng.integers(-24,11,n)
+            dts  = rng.uniform(-0.5,1.5,n)
+            afs  = rng.integers(200,2900,n)
+            kind = rng.integers(0,4,n)
+            lines=[]
+            for j in range(n):
+                call = calls[who[j]]
+                if kind[j]==0:
+                    msg = 'CQ %s FN42' % call
+                elif kind[j]==1:
+                    msg = '%s %s R%+03d' % (mycall,call,snrs[j])
+                elif kind[j]==2:
+                    msg = '%s %s RR73' % (calls[who[j-1]],call)
+                else:
+                    msg = 'CQ DX %s JN58' % call
+                lines.append('%s %9.3f Rx FT8 %6d %4.1f %4d %s\n' % \
+                             (t,dial,snrs[j],dts[j],afs[j],msg))
+            fp.writelines(lines)
+            nlines += n
+
+    return nlines
+
+############################################################################################
+
+# Function to time a stage - returns the best of several runs & the result.
+# The chatter from the stage is thrown away so we don't time the terminal.
+def time_stage(func,repeat=3):
+    best=None
+    for i in range(repeat):
+        with open(os.devnull,'w') as fp, contextlib.redirect_stdout(fp):
+            t0 = time.perf_counter()
+            result = func()
+            dt = time.perf_counter()-t0
+        if best is None or dt<best:
+            best=dt
+    return best,result
+
+# Function to find the peak memory (MB) used by a stage
+def peak_memory(func):
+    tracemalloc.start()
+    with open(os.devnull,'w') as fp, contextlib.redirect_stdout(fp):
+        func()
+    size,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak/1024./1024.
+
+# Function to benchmark a stage & record the results.  n is the number of
+# items (lines, spots, windows) it handles.
+def bench(results,name,func,n,units,repeat=3,memory=True):
+    secs,result = time_stage(func,repeat)
+    rec = {'secs':secs, 'n':n, 'rate':n/secs if secs>0 else 0., 'units':units}
+    if memory:
+        rec['peak_mb'] = peak_memory(func)
+    results[name]=rec
+
+    txt = '  %-14s %9.4f s  %12.1f %s/s' % (name,secs,rec['rate'],units)
+    if memory:
+        txt += '  %8.1f MB' % rec['peak_mb']
+    print(txt)
+    return result
+
+############################################################################################
+
+# Function to run all the benchmarks on a log file
+def run_benchmarks(fname,chdata,nwindows=20,nframes=3,render=True,repeat=3):
+    from dxcc_cache import DxccResolver
+
+    results={}
+    nbytes = os.path.getsize(fname)
+
+    # Parsing
+    def parse():
+        return [cols for cols,offset in parse_batches(read_lines(fname))]
+    batches = bench(results,'parse',parse,nbytes/1e6,'MB',repeat)
+    nlines = sum(len(b[0]) for b in batches)
+    results['parse']['lines'] = nlines
+
+    # Banding & DXCC enrichment - with a fresh resolver each time
+    def enrich():
+        resolver = DxccResolver(chdata)
+        builder  = SpotBuilder()
+        for (ts,band,snr,call,grid,calls),offset in \
+            band_batches( ((b,0) for b in batches) ):
+            builder.append( resolver.enrich(ts,band,snr,call,grid,calls) )
+        return builder.finish()
+    spots = bench(results,'enrich',enrich,nlines,'spots',repeat)
+
+    # Window selection - random day long windows
+    rng = np.random.default_rng(0)
+    t0  = spots.ts[0].astype(datetime)
+    span = max( (spots.ts[-1]-spots.ts[0]).astype(int)-86400 , 1)
+    starts = [t0+timedelta(seconds=int(s)) for s in rng.integers(0,span,nwindows)]
+    def select():
+        return [filter_spots(spots,d,d+timedelta(days=1),Need='New Slots') for d in starts]
+    windows = bench(results,'filter_spots',select,nwindows,'windows',repeat,memory=False)
+
+    def dxccs():
+        return [count_dxccs(w) for w in windows]
+    bench(results,'count_dxccs',dxccs,nwindows,'windows',repeat,memory=False)
+
+    # Drawing a map - the same as the gui does on each update
+    if render:
+        from batch_render import FrameRenderer
+        renderer = FrameRenderer(spots)
+        out = os.path.join(tempfile.gettempdir(),'wsmap_bench.png')
+        def draw():
+            for d in starts[:nframes]:
+                renderer.render(d,d+timedelta(hours=1),'ALL SPOTS',out)
+        bench(results,'update_map',draw,nframes,'frames',repeat,memory=False)
+
+    return results
+
+# Function to compare results against a baseline - returns list of regressions
+def compare(results,baseline,tol=TOLERANCE):
+
+    slower=[]
+    for size,stages in results.items():
+        for name,rec in stages.items():
+            old = baseline.get(size,{}).get(name)
+            if not old:
+                continue
+            ratio = rec['secs']/old['secs'] if old['secs']>0 else 1.
+            flag = ''
+            if ratio>1+tol:
+                flag = '  <-- REGRESSION'
+                slower.append( (size,name,ratio) )
+            print('  %-8s %-14s %9.4f s  was %9.4f s  x%.2f%s' % \
+                  (size,name,rec['secs'],old['secs'],ratio,flag))
+    return slower
+
+############################################################################################
+
+if __name__ == "__main__":
+
+    arg_proc = argparse.ArgumentParser(description='Weak Signal Spot Mapper benchmarks')
+    arg_proc.add_argument('-days', type=float, nargs='+', default=[1,2,7],
+                          help='Sizes of synthetic logs to run (days)')
+    arg_proc.add_argument('-rate', type=float, default=100,
+                          help='Decodes per minute')
+    arg_proc.add_argument('-calls', type=int, default=5000,
+                          help='Number of different calls')
+    arg_proc.add_argument('-zipf', type=float, default=1.2,
+                          help='Zipf exponent for call popularity')
+    arg_proc.add_argument('-bands', nargs='+', choices=BANDS, default=None,
+                          help='Bands to use - default is a typical mix')
+    arg_proc.add_argument('-repeat', type=int, default=3,
+                          help='Number of times to time each stage')
+    arg_proc.add_argument('-norender', action='store_true',
+                          help='Skip map drawing')
+    arg_proc.add_argument('-baseline', type=str, default=BASELINE_FILE,
+                          help='Baseline results file')
+    arg_proc.add_argument('-save', action='store_true',
+                          help='Save results as the new baseline')
+    arg_proc.add_argument('-tol', type=float, default=TOLERANCE,
+                          help='Fractional slow down to flag as a regression')
+    arg_proc.add_argument('-states', type=str, default=None,
+                          help='Challenge data file - default is ~/MY_CALL/states.xls')
+    arg_proc.add_argument('-dir', type=str, default=None,
+                          help='Where to put the synthetic logs - default is a temp dir')
+    arg_proc.add_argument('-only_logs', action='store_true',
+                          help='Just generate the synthetic logs')
+    args = arg_proc.parse_args()
+
+    if args.bands:
+        band_mix = {b:BAND_MIX[b] for b in args.bands}
+    else:
+        band_mix = BAND_MIX
+
+    log_dir = args.dir or tempfile.mkdtemp(prefix='wsmap_bench_')
+    os.makedirs(log_dir,exist_ok=True)
+
+    if not args.only_logs:
+        from dx.spot_processing import ChallengeData
+        fname = args.states
+        if not fname:
+            from settings import read_settings
+            SETTINGS,RCFILE = read_settings('.keyerrc')
+            fname=os.path.expanduser('~/'+SETTINGS['MY_CALL']+'/states.xls')
+        chdata = ChallengeData(fname)
+
+    results={}
+    date1 = datetime(2021,5,1)
+    for days in args.days:
+        size = '%gd' % days
+        log = os.path.join(log_dir,'ALL_%s.TXT' % size)
+        if not os.path.exists(log):
+            print('Generating',log,'...')
+            nlines = make_all_txt(log,date1,days,args.rate,band_mix,args.calls,args.zipf)
+            print('...',nlines,'decodes,',os.path.getsize(log),'bytes')
+        if args.only_logs:
+            continue
+
+        print('\nBenchmarks for',size,'-',log)
+        results[size] = run_benchmarks(log,chdata,render=not args.norender,
+                                       repeat=args.repeat)
+
+    if args.only_logs:
+        sys.exit(0)
+
+    # Compare against the baseline & save if asked to
+    slower=[]
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        print('\nComparison with',args.baseline,'from',baseline.get('date'),':')
+        slower = compare(results,baseline.get('results',{}),args.tol)
+        if slower:
+            print('\n',len(slower),'stage(s) slower by more than %d%%' % (100*args.tol))
+
+    if args.save:
+        with open(args.baseline,'w') as fp:
+            json.dump({'date'     : datetime.now().isoformat(timespec='seconds'),
+                       'python'   : platform.python_version(),
+                       'numpy'    : np.__version__,
+                       'machine'  : platform.machine(),
+                       'rate'     : args.rate,
+                       'calls'    : args.calls,
+                       'zipf'     : args.zipf,
+                       'results'  : results},fp,indent=2)
+        print('Saved baseline to',args.baseline)
+
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,207 @@
+############################################################################################
+#
+# dxcc_cache.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Memoized lookup of DXCC info and challenge needs for the calls we decode.
+#
+# Notes:
+# - Over a week's worth of decodes, the same few thousand calls show up
+#   over and over so there is no point in running the prefix lookup and the
+#   challenge checks for every spot.
+# - Spots are placed at the center of the grid square the station sent, if
+#   we know it, rather than the center of its country.  The last grid each
+#   call sent is remembered and carried over to its later spots, e.g. the
+#   reports and RR73s that follow a CQ.
+# - The need flags are handed out as a (country,band) table which goes along
+#   with the spots.  When the challenge data is re-read or a slot is marked
+#   as worked, only the table needs to be worked out again.  Slots marked
+#   as worked are only remembered until the challenge data catches up.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import Future
+from spot_store import SpotStore, ALL_BANDS, need2mask, intern, empty_needs
+from maidenhead import GRID_LAT, GRID_LON
+from instrument import logger
+
+############################################################################################
+
+# Max number of calls we remember
+MAX_CALLS=50000
+
+############################################################################################
+
+# Resolves calls into (country,lat,lon) and (country,band) into need flags
+class DxccResolver:
+
+    # chdata can also be a future if the challenge data is still being read
+    def __init__(self,chdata,max_calls=MAX_CALLS):
+        self.chdata = chdata
+        self.lookup_call = lru_cache(maxsize=max_calls)(self.station_info)
+        self.needs = {}
+        self.need_hits = 0
+        self.need_misses = 0
+        self.grids = {}                  # Last grid code sent by each call
+        self.worked = set()              # (country,band) slots marked as worked
+
+    # Function to do the actual prefix lookup for a call
+    def station_info(self,call):
+        from dx.spot_processing import Station
+        dx = Station(call)
+        lat = dx.latitude
+        lon = dx.longitude
+        if lon:
+            lon = -float(lon)
+        if lat:
+            lat = float(lat)
+        return dx.country,lat,lon
+
+    # Function to evaluate the need flags for a country on a band
+    def need_mask(self,country,band):
+        key  = (country,band)
+        need = self.needs.get(key)
+        if need is not None:
+            self.need_hits += 1
+            return need
+
+        self.need_misses += 1
+        if isinstance(self.chdata,Future):
+            self.chdata = self.chdata.result()
+            self.prune_worked()
+        need = 0
+        if self.chdata.needed_challenge(country,'ALL',0):
+            need |= need2mask('New DXCCs')
+        if self.chdata.needed_challenge(country,band.upper(),0):
+            need |= need2mask('New Slots')
+        if self.chdata.needed_challenge(country,2021,0):
+            need |= need2mask('DXCC 2021')
+
+        # Take out anything we've worked since the challenge data was saved
+        if key in self.worked:
+            need &= ~need2mask('New Slots')
+        if any([(country,b) in self.worked for b in ALL_BANDS]):
+            need &= ~( need2mask('New DXCCs') | need2mask('DXCC 2021') )
+
+        self.needs[key] = need
+        return need
+
+    # Function to work out the need table for a list of countries
+    def need_table(self,countries):
+        table = empty_needs(len(countries))
+        for i,country in enumerate(countries):
+            for j,band in enumerate(ALL_BANDS):
+                table[i,j] = self.need_mask(country,band)
+        return table
+
+    # Function to switch to new challenge data, e.g. if states.xls has been
+    # updated.  chdata can be a future here too.
+    def reload(self,chdata):
+        self.chdata = chdata
+        self.needs  = {}
+        if not isinstance(chdata,Future):
+            self.prune_worked()
+
+    # Function to forget the slots marked as worked that the challenge data
+    # now has as worked too
+    def prune_worked(self):
+        self.worked = set([(country,band) for country,band in self.worked
+                           if self.chdata.needed_challenge(country,band.upper(),0)])
+
+    # Function to mark a slot as worked
+    def mark_worked(self,country,band):
+        self.worked.add( (country,band) )
+        for b in ALL_BANDS:
+            self.needs.pop( (country,b),None )
+
+    # Function to fill in the last known grid for each spot in a batch.
+    # grid is -1 for spots without one.  The spots must be in the order they
+    # were decoded.
+    def fill_grids(self,call,grid,calls):
+
+        n = len(call)
+        if n==0:
+            return grid
+
+        # Group the spots by call, keeping them in order within each group,
+        # and find the last spot with a grid so far at each spot
+        order = np.argsort(call,kind='stable')
+        c = call[order]
+        g = grid[order]
+        starts = np.flatnonzero( np.diff(c,prepend=-1) )
+        ends   = np.append(starts[1:],n)
+        start  = np.repeat(starts,ends-starts)
+        last   = np.maximum.accumulate( np.where(g>=0,np.arange(n),-1) )
+
+        # Before that, use what we knew from previous batches
+        prev   = np.array([self.grids.get(x,-1) for x in calls],dtype=np.int16)
+        filled = np.where(last>=start,g[last],prev[c])
+
+        # Remember where each call was last
+        for x,code in zip(c[ends-1].tolist(),filled[ends-1].tolist()):
+            if code>=0:
+                self.grids[calls[x]] = code
+
+        grid = np.empty(n,dtype=np.int16)
+        grid[order] = filled
+        return grid
+
+    # Function to fill out DXCC info for a batch of spots.  call indexes
+    # into the list of calls in the batch so each unique call and each
+    # country is only looked up once.  grid is the grid
+    # code, if any, sent with each spot.  Spots older than cutoff only go
+    # towards the grids we remember.  Returns a SpotStore.
+    def enrich(self,ts,band,snr,call,grid,calls,cutoff=None):
+
+        if cutoff is not None:
+            old = ts < np.datetime64(cutoff,'s')
+            if np.any(old):
+                self.fill_grids(call[old],grid[old],calls)
+                keep = ~old
+                used,call = np.unique(call[keep],return_inverse=True)
+                ts,band,snr,call,grid = ts[keep],band[keep],snr[keep],call.astype(np.int32),grid[keep]
+                calls = [calls[i] for i in used]
+
+        info = [self.lookup_call(c) for c in calls]
+
+        countries=[]
+        country_codes={}
+        ccode = np.array([intern(countries,country_codes,x[0]) for x in info],
+                         dtype=np.int16)
+        lat = np.array([np.nan if x[1] is None else x[1] for x in info],dtype=np.float32)
+        lon = np.array([np.nan if x[2] is None else x[2] for x in info],dtype=np.float32)
+        country = ccode[call]
+
+        # Use the grid square if we know it - otherwise the country
+        grid  = self.fill_grids(call,grid,calls)
+        known = grid>=0
+        lat = np.where(known,GRID_LAT[grid],lat[call])
+        lon = np.where(known,GRID_LON[grid],lon[call])
+
+        return SpotStore(ts,band.astype(np.int8),lat,lon,
+                         np.clip(snr,-128,127).astype(np.int8),
+                         call,country,calls,countries,
+                         self.need_table(countries))
+
+    # Function to print cache stats
+    def print_stats(self):
+        info = self.lookup_call.cache_info()
+        logger.info('DXCC cache: calls  - hits= %d \tmisses= %d \tsize= %d',
+                    info.hits,info.misses,info.currsize)
+        logger.info('DXCC cache: needs  - hits= %d \tmisses= %d \tsize= %d',
+                    self.need_hits,self.need_misses,len(self.needs))
+        logger.info('DXCC cache: grids  - %d calls',len(self.grids))
@@ -0,0 +1,150 @@
+############################################################################################
+#
+# instrument.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Lightweight timers, counters, memory snapshots & profiling hooks.
+#
+# Notes:
+# - Diagnostics go through the logging module so the chatter in the inner
+#   loops can be turned down (or up) from the command line.  Use the logger
+#   from here rather than print() in anything that runs per spot, per batch
+#   or per window.
+# - timer() and count() accumulate per stage totals which report() logs,
+#   e.g. spots read per second, filter and draw latency.  They are cheap
+#   enough to leave on all the time and are safe to use from worker threads.
+#   Stages in other processes (e.g. the chunk readers) aren't counted.
+# - The profiler is cProfile or pyinstrument (if it is installed).
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+############################################################################################
+
+logger = logging.getLogger('wsmap')
+
+TIMERS={}                    # name -> [calls, total secs, max secs]
+COUNTERS={}                  # name -> count
+lock = threading.Lock()
+profiler = None
+
+LEVELS=['DEBUG','INFO','WARNING','ERROR']
+
+############################################################################################
+
+# Function to set up logging
+def setup_logging(level='INFO',fname=None):
+    logging.basicConfig(level=getattr(logging,level.upper()),filename=fname,
+                        format='%(asctime)s %(levelname)-7s %(threadName)s: %(message)s')
+
+# Function to time a stage, e.g.
+#    with timer('filter'):
+#        ...
+@contextmanager
+def timer(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name,time.perf_counter()-t0)
+
+# Function to add to the time spent in a stage
+def add_time(name,dt):
+    with lock:
+        rec = TIMERS.get(name)
+        if rec is None:
+            rec = TIMERS[name] = [0,0.,0.]
+        rec[0] += 1
+        rec[1] += dt
+        rec[2]  = max(rec[2],dt)
+    logger.debug('%s took %.1f ms',name,1000.*dt)
+
+# Function to bump a counter.  If there is a timer of the same name, the
+# report includes the rate.
+def count(name,n=1):
+    with lock:
+        COUNTERS[name] = COUNTERS.get(name,0) + n
+
+# Function to log the timers & counters
+def report(level=logging.INFO):
+    with lock:
+        timers   = {k:list(v) for k,v in TIMERS.items()}
+        counters = dict(COUNTERS)
+
+    for name in sorted(timers.keys()):
+        calls,total,tmax = timers[name]
+        txt = 'Timer %-12s %6d calls %9.3f s total %8.2f ms avg %8.2f ms max' % \
+            (name,calls,total,1000.*total/calls,1000.*tmax)
+        if name in counters and total>0:
+            txt += ' %12.0f /s' % (counters[name]/total)
+        logger.log(level,txt)
+    for name in sorted(counters.keys()):
+        logger.log(level,'Count %-12s %12d' % (name,counters[name]))
+
+############################################################################################
+
+# Function to start tracking memory allocations
+def start_memory():
+    tracemalloc.start()
+
+# Function to log memory in use & the biggest allocations, if we're tracking them
+def memory_snapshot(label,top=10):
+    if not tracemalloc.is_tracing():
+        return
+    current,peak = tracemalloc.get_traced_memory()
+    logger.info('Memory %s: %.1f MB in use, %.1f MB peak',label,current/1e6,peak/1e6)
+    stats = tracemalloc.take_snapshot().statistics('lineno')
+    for stat in stats[:top]:
+        logger.info('    %s',stat)
+
+############################################################################################
+
+# Function to start profiling - kind is 'cprofile' or 'pyinstrument'
+def start_profile(kind):
+    global profiler
+
+    if kind=='pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning('pyinstrument not installed - using cProfile')
+            kind='cprofile'
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+# Function to stop profiling & print the results
+def stop_profile():
+    global profiler
+
+    if profiler is None:
+        return
+    if hasattr(profiler,'output_text'):
+        profiler.stop()
+        print(profiler.output_text(unicode=True,color=False))
+    else:
+        profiler.disable()
+        profiler.print_stats(sort='time')
+    profiler = None
@@ -0,0 +1,60 @@
+############################################################################################
+#
+# maidenhead.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Maidenhead grid squares - e.g. FN42 - as sent in FT8/FT4 messages.
+#
+# Notes:
+# - There are 18x18 fields each with 10x10 squares for 32,400 squares in all.
+#   A square is 2 deg of longitude by 1 deg of latitude.
+# - Each square gets a small integer code, 180*lon index + lat index, and
+#   the lat & lon of all the square centers are worked out once up front so
+#   converting an array of codes is just an array lookup.  -1 means no grid.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import re
+import numpy as np
+
+############################################################################################
+
+NFIELDS=18
+NSQUARES=10
+NSTEPS=NFIELDS*NSQUARES          # Squares around in each direction
+NGRIDS=NSTEPS*NSTEPS
+
+GRID_RE = re.compile('^[A-R]{2}[0-9]{2}$')
+
+# Center of each square
+GRID_LON = np.repeat( -180. + 2.*np.arange(NSTEPS) + 1.  , NSTEPS ).astype(np.float32)
+GRID_LAT = np.tile(    -90. +    np.arange(NSTEPS) + 0.5 , NSTEPS ).astype(np.float32)
+
+############################################################################################
+
+# Function to convert a grid square into its code - returns -1 if it isn't one.
+# RR73 looks like a grid but is really a sign-off.
+def grid2code(grid):
+    if not GRID_RE.match(grid) or grid=='RR73':
+        return -1
+    ilon = NSQUARES*(ord(grid[0])-ord('A')) + int(grid[2])
+    ilat = NSQUARES*(ord(grid[1])-ord('A')) + int(grid[3])
+    return ilon*NSTEPS + ilat
+
+# Function to convert a code back into a grid square
+def code2grid(code):
+    ilon,ilat = divmod(code,NSTEPS)
+    return chr(ord('A')+ilon//NSQUARES) + chr(ord('A')+ilat//NSQUARES) + \
+        str(ilon%NSQUARES) + str(ilat%NSQUARES)
@@ -0,0 +1,153 @@
+############################################################################################
+#
+# map_background.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Pre-rendered map background for the spot map.
+#
+# Notes:
+# - Drawing the shaded relief, coastlines, etc. with Basemap takes a good
+#   chunk of the startup time so we render them once into an image and
+#   reuse it on later starts.  The image is keyed by projection, extent,
+#   relief scale and canvas size.
+# - Basemap is only imported when we actually have to render a background.
+# - Only the cylindrical projection is handled here since it lets us plot
+#   spots directly in lon/lat.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import os
+import numpy as np
+from itertools import chain
+import matplotlib.image as mpimg
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap
+from nightshade import NightCache
+
+############################################################################################
+
+BG_DIR='map_cache'
+
+# Extent of the map - llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat
+EXTENT=(-180.,180.,-90.,90.)
+
+############################################################################################
+
+# Function to import Basemap - only called when we really need it
+def import_basemap():
+
+    # JBA - this fixes a bug? in mpl_toolkits
+    # It appears that basemaps (& python 2.7) are about to become obsolete so
+    # it is time to start looking for an alternative.
+    import mpl_toolkits
+    mpl_toolkits.__path__.append('/usr/lib/python2.7/dist-packages/mpl_toolkits/')
+    from mpl_toolkits.basemap import Basemap
+    return Basemap
+
+# Function to form the name of the cached background image
+def background_file(projection,extent,scale,width,height):
+    key = '%s_%g_%g_%g_%g_%g_%dx%d' % ((projection,)+tuple(extent)+(scale,width,height))
+    return os.path.join(BG_DIR,'bg_'+key+'.png')
+
+# Function to draw the map background with Basemap and save it to a file
+def render_background(fname,extent,scale,width,height,alpha=0.7):
+
+    print('Rendering map background',fname,'...')
+    Basemap = import_basemap()
+
+    dpi=100
+    fig = Figure(figsize=(width/dpi,height/dpi),dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0,0,1,1])
+    ax.axis('off')
+
+    m = Basemap(projection='cyl', resolution='c',
+                llcrnrlon=extent[0], urcrnrlon=extent[1],
+                llcrnrlat=extent[2], urcrnrlat=extent[3],
+                fix_aspect=False, ax=ax)
+    m.shadedrelief(scale=scale)
+    #m.bluemarble(scale=scale)
+    #m.etopo(scale=scale)
+
+    # lats and longs are returned as a dictionary
+    lats = m.drawparallels(np.linspace(-90, 90, 13))
+    lons = m.drawmeridians(np.linspace(-180, 180, 13))
+
+    # keys contain the plt.Line2D instances
+    lat_lines = chain(*(tup[1][0] for tup in lats.items()))
+    lon_lines = chain(*(tup[1][0] for tup in lons.items()))
+    all_lines = chain(lat_lines, lon_lines)
+
+    # cycle through these lines and set the desired style
+    for line in all_lines:
+        line.set(linestyle='-', alpha=alpha, color='w')
+
+    # Draw politcal boundaries
+    m.drawcoastlines()
+    m.drawstates()
+    m.drawcountries()
+
+    ax.set_xlim(extent[0],extent[1])
+    ax.set_ylim(extent[2],extent[3])
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    fig.savefig(fname,dpi=dpi)
+    print('... Rendered map background.')
+
+############################################################################################
+
+# Stand-in for a cylindrical Basemap which draws on top of a cached background.
+# Map coords are just lon & lat.
+class CylMap:
+
+    def __init__(self,ax,extent=EXTENT):
+        self.ax = ax
+        self.extent = extent
+        self.night = None
+        self.night_cache = NightCache()
+
+    # Function to put up the background, rendering it first if we have to
+    def draw_background(self,scale,width,height,alpha=0.7):
+        fname = background_file('cyl',self.extent,scale,width,height)
+        if not os.path.exists(fname):
+            render_background(fname,self.extent,scale,width,height,alpha)
+        img = mpimg.imread(fname)
+
+        self.ax.imshow(img,extent=self.extent,origin='upper',aspect='auto',
+                       interpolation='bilinear',zorder=0)
+        self.ax.set_xlim(self.extent[0],self.extent[1])
+        self.ax.set_ylim(self.extent[2],self.extent[3])
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+
+    # Function to convert lon/lat to map coords
+    def __call__(self,lons,lats):
+        return np.asarray(lons),np.asarray(lats)
+
+    def scatter(self,x,y,**kwargs):
+        return self.ax.scatter(x,y,**kwargs)
+
+    # Function to shade the night side of the map.  The image is created the
+    # first time through and after that we just swap in the new mask.
+    def nightshade(self,date,alpha=0.2):
+        mask = self.night_cache.get(date)
+        if self.night is None:
+            cmap = ListedColormap([(0.,0.,0.,0.),(0.,0.,0.,alpha)])
+            self.night = self.ax.imshow(mask,extent=EXTENT,origin='lower',aspect='auto',
+                                        cmap=cmap,vmin=0,vmax=1,
+                                        interpolation='nearest',zorder=0.5)
+        else:
+            self.night.set_data(mask)
+        return self.night
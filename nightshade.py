@@ -0,0 +1,131 @@
+############################################################################################
+#
+# nightshade.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Routines to shade the night side of a lat/lon map.
+#
+# Notes:
+# - This does the same job as Basemap's nightshade() but produces a mask
+#   which is shown as an image rather than a set of filled contours.  This way we don't need
+#   Basemap at all once the map background has been cached.
+# - NightCache keeps a bit-packed night mask for each time we've shaded so
+#   stepping back & forth through the spots doesn't recompute them.  Masks
+#   for a range of times can be computed ahead of time in a background thread.
+# - The sun position uses the low precision formulas from the Astronomical
+#   Almanac which are good to about 0.01 deg - plenty for a grey line.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import numpy as np
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+############################################################################################
+
+# Function to compute the lat & lon (deg) where the sun is directly overhead
+# at a particular UTC date & time
+def subsolar_point(date):
+
+    # Days since J2000.0
+    d = (date - datetime(2000,1,1,12)).total_seconds()/86400.
+
+    # Ecliptic longitude of the sun & obliquity of the ecliptic
+    g = np.radians( 357.529 + 0.98560028*d )
+    q = 280.459 + 0.98564736*d
+    L = np.radians( q + 1.915*np.sin(g) + 0.020*np.sin(2*g) )
+    e = np.radians( 23.439 - 0.00000036*d )
+
+    # Declination & right ascension
+    dec = np.arcsin( np.sin(e)*np.sin(L) )
+    ra  = np.arctan2( np.cos(e)*np.sin(L), np.cos(L) )
+
+    # Greenwich mean sidereal time, in deg
+    gmst = 280.46061837 + 360.98564736629*d
+
+    lat = np.degrees(dec)
+    lon = (np.degrees(ra) - gmst + 180.) % 360. - 180.
+    return lat,lon
+
+# Function to compute a mask that is true on the night side.  Rows go from
+# -90 to 90 deg lat and columns from -180 to 180 deg lon, delta deg apart.
+def night_mask(date,delta=0.5):
+
+    lat0,lon0 = subsolar_point(date)
+    lats = np.radians( np.arange(-90.,90.+delta/2,delta) )
+    lons = np.radians( np.arange(-180.,180.+delta/2,delta) )
+
+    # Cosine of the sun's zenith angle is negative on the night side
+    cosz = np.outer( np.sin(lats), np.ones(len(lons)) )*np.sin(np.radians(lat0)) + \
+        np.outer( np.cos(lats), np.cos(lons-np.radians(lon0)) )*np.cos(np.radians(lat0))
+    return cosz<0
+
+############################################################################################
+
+# Bounded cache of night masks
+class NightCache:
+
+    def __init__(self,delta=0.5,max_size=24*8):
+        self.delta    = delta
+        self.max_size = max_size
+        self.masks    = OrderedDict()
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+        self.thread   = None
+
+    # Function to get the night mask for a particular date & time
+    def get(self,date):
+        with self.lock:
+            packed = self.masks.get(date)
+            if packed is not None:
+                self.masks.move_to_end(date)
+                self.hits += 1
+        if packed is None:
+            self.misses += 1
+            mask = night_mask(date,self.delta)
+            self.put(date,mask)
+            return mask.astype(np.uint8)
+        else:
+            return np.unpackbits(packed,count=self.size).reshape(self.shape)
+
+    # Function to add a mask to the cache, dropping the oldest if it's full
+    def put(self,date,mask):
+        self.shape = mask.shape
+        self.size  = mask.size
+        packed = np.packbits(mask)
+        with self.lock:
+            self.masks[date] = packed
+            self.masks.move_to_end(date)
+            while len(self.masks)>self.max_size:
+                self.masks.popitem(last=False)
+
+    # Function to compute masks for every hour from date1 to date2 in a
+    # background thread.  If they won't all fit, the latest ones win.
+    def prefetch(self,date1,date2):
+        date1 = date1.replace(minute=0,second=0,microsecond=0)
+        hours = int( (date2-date1).total_seconds()//3600 )+1
+        dates = [date1+timedelta(hours=h) for h in range(max(hours-self.max_size,0),hours)]
+
+        def worker():
+            for date in dates:
+                with self.lock:
+                    have = date in self.masks
+                if not have:
+                    self.put(date,night_mask(date,self.delta))
+
+        self.thread = threading.Thread(target=worker,daemon=True)
+        self.thread.start()
@@ -0,0 +1,97 @@
+############################################################################################
+#
+# spot_cache.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# On-disk cache of enriched spots so we don't have to re-read all of the
+# ALL.TXT files every time we start up.
+#
+# Notes:
+# - The spot columns are saved in a numpy .npz file along with a json blob
+#   holding the string tables and the state of each log file (size, mtime,
+#   byte offset, etc.) when we last read it.
+# - The last grid square heard from each call is saved too so spots read
+#   later on can still be placed on the map.
+# - So is the (country,band) need table.  If the challenge data has changed
+#   since, the spots are still good - only the table has to be redone.
+# - Bump CACHE_VERSION whenever the layout changes - old caches are ignored.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import os
+import json
+import numpy as np
+from spot_store import SpotStore, COLUMNS
+from maidenhead import grid2code, code2grid
+
+############################################################################################
+
+CACHE_VERSION=3
+
+############################################################################################
+
+# Function to get the mod time of a file, None if it doesn't exist
+def mod_time(fname):
+    if fname and os.path.exists(fname):
+        return os.path.getmtime(fname)
+    else:
+        return None
+
+# Function to save spots, log file states and the last grid of each call
+def save_cache(fname,spots,files,states_file=None,grids={}):
+
+    meta = {'version'     : CACHE_VERSION,
+            'states_file' : states_file,
+            'states_mtime': mod_time(states_file),
+            'files'       : files,
+            'calls'       : spots.calls,
+            'countries'   : spots.countries,
+            'grids'       : {call:code2grid(code) for call,code in grids.items()}}
+
+    # Write to a temp file first so a crash doesn't leave us with a corrupt cache
+    tmp = fname+'.tmp'
+    with open(tmp,'wb') as fp:
+        np.savez(fp,meta=np.array(json.dumps(meta)),needs=spots.needs,
+                 **{col:getattr(spots,col) for col in COLUMNS})
+    os.replace(tmp,fname)
+
+# Function to load spots, log file states and grids.  Returns (None,{},{})
+# if there is no valid cache.
+def load_cache(fname,states_file=None):
+
+    if not os.path.exists(fname):
+        return None,{},{}
+
+    try:
+        with np.load(fname,allow_pickle=False) as data:
+            meta = json.loads( str(data['meta']) )
+            if meta['version']!=CACHE_VERSION:
+                print('Spot cache',fname,'is out of date - ignoring')
+                return None,{},{}
+
+            # The need flags depend on the challenge data
+            if meta['states_file']!=states_file or \
+               meta['states_mtime']!=mod_time(states_file):
+                print('Challenge data has changed - need flags will be re-evaluated')
+
+            cols  = [data[col] for col in COLUMNS]
+            needs = data['needs']
+    except Exception as e:
+        print('Unable to read spot cache',fname,':',e)
+        return None,{},{}
+
+    spots = SpotStore(*cols,meta['calls'],meta['countries'],needs)
+    grids = {call:grid2code(grid) for call,grid in meta['grids'].items()}
+    return spots,meta['files'],grids
@@ -0,0 +1,126 @@
+############################################################################################
+#
+# spot_cube.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Hourly histogram of spots for quick window statistics.
+#
+# Notes:
+# - Spots are binned by (hour, band, country).  For each (hour, band) we
+#   keep the number of spots and a bitset of the countries heard so the
+#   number of DXCCs and slots in a window can be found by OR-ing a few
+#   bitsets together rather than scanning the spots.
+# - The need categories - all spots plus each of the need flags - only
+#   depend on country & band so they are applied by AND-ing with a bitset
+#   of the countries needed on each band.  These come from the need table
+#   of the spots and can be swapped out with set_needs().
+# - Only windows that start and end on an hour can be answered this way.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import numpy as np
+from spot_store import ALL_BANDS, NEED_FLAGS, datetime2ts
+from instrument import logger
+
+############################################################################################
+
+CATEGORIES=['ALL SPOTS']+NEED_FLAGS
+
+# Number of bits set in each byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)],dtype=np.int32)
+
+ONE_HOUR = np.timedelta64(1,'h')
+
+############################################################################################
+
+class SpotCube:
+
+    def __init__(self,spots):
+
+        nbands     = len(ALL_BANDS)
+        ncountries = max(len(spots.countries),1)
+
+        if len(spots)==0:
+            self.t0    = None
+            self.nbins = 0
+        else:
+            self.t0    = spots.ts[0].astype('datetime64[h]')
+            hour       = ( (spots.ts-self.t0)//ONE_HOUR ).astype(np.int64)
+            self.nbins = int(hour[-1])+1
+
+        # Count spots in each bin
+        size = self.nbins*nbands*ncountries
+        if self.nbins>0:
+            idx = (hour*nbands + spots.band)*ncountries + spots.country
+            counts = np.bincount(idx,minlength=size)
+        else:
+            counts = np.zeros(size,dtype=np.int32)
+        counts = counts.reshape(self.nbins,nbands,ncountries)
+
+        # Spots per (hour,band) & bitsets of countries heard
+        self.ncountries = ncountries
+        self.totals = counts.sum(axis=2)
+        self.bits   = np.packbits(counts>0,axis=2)               # hour, band, bytes
+        self.set_needs(spots.needs)
+
+        logger.info('Spot cube: %d hours %d bytes',self.nbins,self.totals.nbytes+self.bits.nbytes)
+
+    # Function to work out the bitsets of the countries needed on each band
+    # for each category from a need table
+    def set_needs(self,needs):
+        table = np.zeros( (self.ncountries,len(ALL_BANDS)), dtype=np.uint8 )
+        table[:len(needs)] = needs
+        sel = np.ones( (len(CATEGORIES),len(ALL_BANDS),self.ncountries), dtype=bool )
+        for cat in range(1,len(CATEGORIES)):
+            sel[cat] = ( (table & (1<<(cat-1))) != 0 ).T
+        self.need_bits = np.packbits(sel,axis=2)                 # cat, band, bytes
+
+    # Function to convert a window into a range of hour bins - returns None
+    # if the window doesn't line up with the bins
+    def bins(self,date1,date2):
+        if self.t0 is None:
+            return None
+        dt1 = datetime2ts(date1) - self.t0
+        dt2 = datetime2ts(date2) - self.t0
+        if dt1%ONE_HOUR!=np.timedelta64(0) or dt2%ONE_HOUR!=np.timedelta64(0):
+            return None
+        h1 = int( min(max(dt1//ONE_HOUR,0),self.nbins) )
+        h2 = int( min(max(dt2//ONE_HOUR,0),self.nbins) )
+        return h1,h2
+
+    # Function to compute number of spots, DXCCs & slots in a window on a
+    # list of band codes.  The number of spots is always for all spots.
+    # Returns None if the window can't be answered from the cube.
+    def window_stats(self,date1,date2,Need,codes):
+
+        hours = self.bins(date1,date2)
+        if hours is None:
+            return None
+        h1,h2 = hours
+        if h2<=h1:
+            return 0,0,0
+
+        cat    = CATEGORIES.index(Need)
+        nspots = int( self.totals[h1:h2][:,codes].sum() )
+
+        # OR together the bitsets for each band over the window & keep the
+        # countries needed - the slots are the bits set on each band and the
+        # DXCCs are the bits set on any
+        bits   = np.bitwise_or.reduce(self.bits[h1:h2][:,codes,:],axis=0) & \
+            self.need_bits[cat][codes]
+        nslots = int( POPCOUNT[bits].sum() )
+        ndxcc  = int( POPCOUNT[np.bitwise_or.reduce(bits,axis=0)].sum() )
+
+        return nspots,ndxcc,nslots
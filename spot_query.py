@@ -0,0 +1,300 @@
+############################################################################################
+#
+# spot_query.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Query layer over the loaded spots, e.g. for station dashboards, plus a
+# small local HTTP/JSON server so they don't need to run the gui.
+#
+# Notes:
+# - The queries have the same meaning as the gui - a window is [date1,date2)
+#   in UTC and Need is one of NEEDS - and use the same filter_spots(),
+#   count_dxccs() & window_stats() under the hood.
+# - All the queries share one in-memory store & index.  When new spots come
+#   in, update() swaps in a new store & cube in one go so a query in flight
+#   always sees one or the other, never half of each.
+# - The server is plain asyncio so there is nothing else to install.  It
+#   only handles GET and answers, e.g.
+#      http://localhost:8073/counts?start=20210620_1200&hours=2&need=New+Slots
+#      http://localhost:8073/slots?bands=20m,40m
+#   The queries run on a thread pool so a slow one doesn't hold up the rest.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import json
+import asyncio
+import numpy as np
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from spot_store import ALL_BANDS, NEED_FLAGS
+from spot_cube import SpotCube
+from spot_window import BANDS, count_dxccs, filter_spots, window_stats, dedup_spots
+from instrument import logger, timer, count
+
+############################################################################################
+
+NEEDS=['ALL SPOTS']+NEED_FLAGS
+
+HOST='127.0.0.1'             # Only answer on this machine by default
+PORT=8073
+NUM_THREADS=4
+MAX_REQUEST=8192             # Longest request we'll read (bytes)
+
+############################################################################################
+
+# Function to convert a date in a query - YYYYMMDD, YYYYMMDD_HHMM or ISO format
+def query_date(txt):
+    for fmt in ['%Y%m%d_%H%M','%Y%m%d']:
+        try:
+            return datetime.strptime(txt,fmt)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(txt)
+
+# Function to convert a numpy time stamp into text for the replies
+def ts2str(ts):
+    return np.datetime_as_string(ts,unit='s').tolist()
+
+############################################################################################
+
+# Class to answer queries about the spots
+class SpotQuery:
+
+    def __init__(self,spots,cube=None):
+        self.update(spots,cube)
+
+    # Function to swap in a new set of spots
+    def update(self,spots,cube=None):
+        if cube is None:
+            cube = SpotCube(spots)
+        spots.build_index()
+        self.data = (spots,cube)
+
+    # Function to fill in the defaults for a window - if we're not told, we
+    # use the last hour(s) with spots in it
+    def window(self,spots,date1=None,date2=None,hours=1,Need='ALL SPOTS',bands=None):
+        if Need not in NEEDS:
+            raise ValueError('Unknown need '+str(Need))
+        if not bands:
+            bands = BANDS
+        for band in bands:
+            if band not in ALL_BANDS:
+                raise ValueError('Unknown band '+str(band))
+        if date2 is None:
+            if date1 is not None:
+                date2 = date1 + timedelta(hours=hours)
+            elif len(spots)>0:
+                date2 = spots.ts[-1].astype(datetime).replace(minute=0,second=0) + \
+                    timedelta(hours=1)
+            else:
+                date2 = datetime.utcnow().replace(minute=0,second=0,microsecond=0)
+        if date1 is None:
+            date1 = date2 - timedelta(hours=hours)
+        return date1,date2,Need,list(bands)
+
+    # Function to describe a window in a reply
+    def header(self,date1,date2,Need,bands):
+        return {'start' : date1.isoformat(),
+                'stop'  : date2.isoformat(),
+                'need'  : Need,
+                'bands' : bands}
+
+    # Function to count spots, DXCCs & slots in a window, in all and on each band
+    def counts(self,date1=None,date2=None,hours=1,Need='ALL SPOTS',bands=None):
+        spots,cube = self.data
+        date1,date2,Need,bands = self.window(spots,date1,date2,hours,Need,bands)
+
+        reply = self.header(date1,date2,Need,bands)
+        reply['spots'],reply['dxccs'],reply['slots'] = \
+            window_stats(spots,cube,date1,date2,Need,bands)
+        reply['per_band'] = {}
+        for band in bands:
+            nspots,ndxcc,nslots = window_stats(spots,cube,date1,date2,Need,[band])
+            reply['per_band'][band] = {'spots':nspots,'dxccs':ndxcc}
+        return reply
+
+    # Function to list the slots (countries) heard on each band in a window
+    def slots(self,date1=None,date2=None,hours=1,Need='ALL SPOTS',bands=None):
+        spots,cube = self.data
+        date1,date2,Need,bands = self.window(spots,date1,date2,hours,Need,bands)
+
+        reply = self.header(date1,date2,Need,bands)
+        reply['slots'] = {}
+        for band in bands:
+            spots2 = filter_spots(spots,date1,date2,band=band,Need=Need)
+            reply['slots'][band] = sorted( count_dxccs(spots2) )
+        return reply
+
+    # Function to list the DXCCs heard on any band in a window
+    def dxccs(self,date1=None,date2=None,hours=1,Need='ALL SPOTS',bands=None):
+        spots,cube = self.data
+        date1,date2,Need,bands = self.window(spots,date1,date2,hours,Need,bands)
+
+        reply = self.header(date1,date2,Need,bands)
+        spots2 = filter_spots(spots,date1,date2,band=bands,Need=Need)
+        reply['dxccs'] = sorted( count_dxccs(spots2) )
+        return reply
+
+    # Function to list the stations heard on each band in a window - one
+    # row per station with its best SNR, number of spots & first/last time
+    def stations(self,date1=None,date2=None,hours=1,Need='ALL SPOTS',bands=None):
+        spots,cube = self.data
+        date1,date2,Need,bands = self.window(spots,date1,date2,hours,Need,bands)
+
+        reply = self.header(date1,date2,Need,bands)
+        reply['stations'] = {}
+        for band in bands:
+            spots2 = filter_spots(spots,date1,date2,band=band,Need=Need)
+            stations,counts,first,last = dedup_spots(spots2)
+            rows=[]
+            for i,(call,country) in enumerate(zip(stations.call.tolist(),
+                                                  stations.country.tolist())):
+                rows.append({'call'    : stations.calls[call],
+                             'country' : stations.countries[country],
+                             'snr'     : int(stations.snr[i]),
+                             'spots'   : int(counts[i]),
+                             'first'   : ts2str(first[i]),
+                             'last'    : ts2str(last[i])})
+            reply['stations'][band] = rows
+        return reply
+
+    # Function to answer a query by name with its arguments as text, e.g.
+    # from the server.  Raises KeyError or ValueError if it doesn't make sense.
+    def query(self,name,args):
+        if name not in QUERIES:
+            raise KeyError(name)
+
+        kwargs={}
+        for key in ['start','stop']:
+            if key in args:
+                kwargs['date1' if key=='start' else 'date2'] = query_date(args[key])
+        if 'hours' in args:
+            kwargs['hours'] = float(args['hours'])
+        if 'need' in args:
+            kwargs['Need'] = args['need']
+        if 'bands' in args:
+            kwargs['bands'] = [b for b in args['bands'].split(',') if b]
+
+        with timer('query'):
+            reply = getattr(self,name)(**kwargs)
+        count('query')
+        return reply
+
+QUERIES=['counts','slots','dxccs','stations']
+
+############################################################################################
+
+# Class to serve queries over http
+class QueryServer:
+
+    def __init__(self,query,host=HOST,port=PORT,nthreads=NUM_THREADS):
+        self.query = query
+        self.host  = host
+        self.port  = port
+        self.pool  = ThreadPoolExecutor(max_workers=nthreads)
+
+    # Function to start listening
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle,self.host,self.port,
+                                                 limit=MAX_REQUEST)
+        print('Serving spot queries on http://%s:%d/' % (self.host,self.port))
+        return self.server
+
+    # Function to handle a connection - one request per connection
+    async def handle(self,reader,writer):
+        try:
+            try:
+                request = await reader.readuntil(b'\r\n\r\n')
+                status,reply = await self.respond(request.decode('latin-1'))
+            except (asyncio.IncompleteReadError,ConnectionError):
+                return
+            except asyncio.LimitOverrunError:
+                # The reader stops at MAX_REQUEST bytes without the end of
+                # the headers
+                status,reply = 413,{'error':'request too long'}
+
+            body = json.dumps(reply).encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\n' % (status,REASONS[status]) +
+                          'Content-Type: application/json\r\n' +
+                          'Content-Length: %d\r\n' % len(body) +
+                          'Access-Control-Allow-Origin: *\r\n' +
+                          'Connection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception('Unable to handle request')
+        finally:
+            writer.close()
+
+    # Function to work out the reply to a request
+    async def respond(self,request):
+        try:
+            method,target,version = request.split('\r\n')[0].split(' ')
+        except ValueError:
+            return 400,{'error':'bad request'}
+        if method!='GET':
+            return 405,{'error':'only GET is supported'}
+
+        url  = urlsplit(target)
+        name = url.path.strip('/')
+        args = {k:v[-1] for k,v in parse_qs(url.query).items()}
+        if name=='':
+            return 200,{'queries':QUERIES,'needs':NEEDS,'bands':BANDS}
+
+        if name not in QUERIES:
+            return 404,{'error':'unknown query '+name}
+
+        logger.debug('Query %s %s',name,args)
+        loop = asyncio.get_running_loop()
+        try:
+            reply = await loop.run_in_executor(self.pool,self.query.query,name,args)
+        except (ValueError,OverflowError,TypeError) as e:
+            # e.g. a date or number of hours that is out of range
+            return 400,{'error':str(e)}
+        except Exception:
+            logger.exception('Query %s %s failed',name,args)
+            return 500,{'error':'internal error'}
+        return 200,reply
+
+REASONS={200:'OK',400:'Bad Request',404:'Not Found',405:'Method Not Allowed',
+         413:'Payload Too Large',500:'Internal Server Error'}
+
+# Function to run the server until we're interrupted.  If poll is given,
+# it is called every poll_secs (on the thread pool) and should return new
+# spots to serve or None if there aren't any.
+def serve(query,host=HOST,port=PORT,poll=None,poll_secs=15):
+
+    async def main():
+        server = QueryServer(query,host,port)
+        await server.start()
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(poll_secs)
+            if poll:
+                # Keep serving what we have if reading new spots fails, e.g.
+                # if a log file is rotated while we're reading it
+                try:
+                    spots = await loop.run_in_executor(server.pool,poll)
+                    if spots is not None:
+                        await loop.run_in_executor(server.pool,query.update,spots)
+                except Exception:
+                    logger.exception('Unable to read new spots')
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,324 @@
+############################################################################################
+#
+# spot_store.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Columnar storage for spots decoded from wsjt.
+#
+# Notes:
+# - A list of dicts costs several hundred bytes per decode which adds up fast
+#   when we load a week's worth of ALL.TXT files.  Here we keep one numpy
+#   array per field instead and intern the call and country strings so each
+#   spot only carries a few small integer codes.
+# - Whether a spot is needed only depends on its country & band so the need
+#   flags are kept in a small (country,band) table rather than with each
+#   spot.  When the challenge data changes, only the table has to be
+#   worked out again.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import numpy as np
+from datetime import datetime
+from instrument import logger
+
+############################################################################################
+
+# All the bands a spot can be assigned to - the band code stored for each spot
+# is the index into this list
+ALL_BANDS=['160m','80m','60m','40m','30m','20m','17m','15m','12m','10m','6m']
+
+# Upper edges (MHz) of each band in ALL_BANDS, anything above the last one is 6m
+BAND_EDGES=np.array([3.,5.,6.,9.,12.,16.,20.,23.,27.,40.])
+
+# Spot columns and their types
+COLUMNS=['ts','band','lat','lon','snr','call','country']
+DTYPES=['datetime64[s]',np.int8,np.float32,np.float32,np.int8,np.int32,np.int16]
+
+# Need flags - bit i of the need mask is set if the spot is needed for NEED_FLAGS[i]
+NEED_FLAGS=['New DXCCs','New Slots','DXCC 2021']
+
+############################################################################################
+
+# Function to convert a band name, e.g. '20m', into its code
+def band2code(band):
+    return ALL_BANDS.index(band)
+
+# Function to classify an array of frequencies (KHz) into band codes
+def freqs2codes(freqs):
+    frqs = .001*np.asarray(freqs,dtype=np.float64)
+    return np.searchsorted(BAND_EDGES,frqs,side='right').astype(np.int8)
+
+# Function to correct band switches while decoding - if we switched bands
+# part way through an interval, the spots decoded in that interval get the
+# band we were on at the start of it.  Spots must be in the order they were
+# decoded.  last_ts and last_code carry this over from a previous batch.
+def fix_band_switches(ts,codes,last_ts=None,last_code=None):
+
+    n = len(ts)
+    if n==0:
+        return codes
+
+    # Find the start of each run of spots with the same time stamp
+    start = np.ones(n,dtype=bool)
+    start[1:] = ts[1:]!=ts[:-1]
+    run = np.cumsum(start)-1
+
+    firsts = codes[start]
+    if last_ts is not None and ts[0]==last_ts:
+        firsts[0] = last_code
+
+    fixed = firsts[run]
+    nswitch = np.count_nonzero(fixed!=codes)
+    if nswitch>0:
+        logger.info('Whoops! Looks like a band switch during interval: %d spots fixed',nswitch)
+    return fixed
+
+# Function to convert a need selection into its bit mask - 0 means all spots
+def need2mask(Need):
+    if Need in NEED_FLAGS:
+        return 1 << NEED_FLAGS.index(Need)
+    else:
+        return 0
+
+# Function to convert a datetime into a numpy time stamp
+def datetime2ts(date):
+    if date.tzinfo is not None:
+        date = date.replace(tzinfo=None) - date.utcoffset()
+    return np.datetime64(date,'s')
+
+# Function to create an empty need table for some number of countries
+def empty_needs(ncountries=0):
+    return np.zeros( (ncountries,len(ALL_BANDS)), dtype=np.uint8 )
+
+# Function to intern a string - returns its index in table
+def intern(table,codes,val):
+    code = codes.get(val)
+    if code is None:
+        code = len(table)
+        codes[val] = code
+        table.append(val)
+    return code
+
+############################################################################################
+
+# Columnar table of spots
+class SpotStore:
+
+    def __init__(self,ts,band,lat,lon,snr,call,country,calls,countries,needs=None):
+
+        self.ts      = ts                # datetime64[s], UTC
+        self.band    = band              # int8 index into ALL_BANDS
+        self.lat     = lat               # float32, nan if unknown
+        self.lon     = lon               # float32, nan if unknown
+        self.snr     = snr               # int8
+        self.call    = call              # int32 index into calls
+        self.country = country           # int16 index into countries
+
+        # String tables shared by all views of this store
+        self.calls     = calls
+        self.countries = countries
+
+        # uint8 need bit mask for each (country,band), see NEED_FLAGS
+        if needs is None:
+            needs = empty_needs(len(countries))
+        self.needs = needs
+
+        # Per-band time indexes - built on demand
+        self.band_rows = None
+        self.band_ts   = None
+
+    def __len__(self):
+        return len(self.ts)
+
+    # Function to create an empty store
+    @classmethod
+    def empty(cls):
+        return SpotBuilder().finish()
+
+    # Function to select a subset of spots - idx can be a mask, index array or slice.
+    # The selection should preserve time order.
+    def take(self,idx):
+        return SpotStore(self.ts[idx],self.band[idx],self.lat[idx],self.lon[idx],
+                         self.snr[idx],self.call[idx],self.country[idx],
+                         self.calls,self.countries,self.needs)
+
+    # Function to make a view of this store with a different need table
+    def with_needs(self,needs):
+        spots = SpotStore(self.ts,self.band,self.lat,self.lon,self.snr,self.call,
+                          self.country,self.calls,self.countries,needs)
+        spots.band_rows = self.band_rows
+        spots.band_ts   = self.band_ts
+        return spots
+
+    # Function to put spots in time order - required by the time index.
+    # The spots usually come in as a few runs that are already in order,
+    # e.g. one per log file, which the stable sort (timsort) just merges.
+    # The columns are reordered one at a time to keep the peak memory down.
+    def sort(self):
+        if len(self)>1 and np.any(self.ts[1:]<self.ts[:-1]):
+            idx = np.argsort(self.ts,kind='stable')
+            self.ts      = self.ts[idx]
+            self.band    = self.band[idx]
+            self.lat     = self.lat[idx]
+            self.lon     = self.lon[idx]
+            self.snr     = self.snr[idx]
+            self.call    = self.call[idx]
+            self.country = self.country[idx]
+        self.band_rows = None
+        self.band_ts   = None
+
+    # Function to build the per-band indexes.  Since the spots are in
+    # time order, the rows for each band are too.
+    def build_index(self):
+        self.band_rows = []
+        self.band_ts   = []
+        for code in range(len(ALL_BANDS)):
+            rows = np.flatnonzero(self.band==code).astype(np.int32)
+            self.band_rows.append(rows)
+            self.band_ts.append(self.ts[rows])
+
+    # Function to find the range of a sorted array of time stamps in [date1,date2)
+    def span(self,ts,date1=None,date2=None):
+        if date1:
+            i1 = np.searchsorted(ts,datetime2ts(date1),side='left')
+        else:
+            i1 = 0
+        if date2:
+            i2 = np.searchsorted(ts,datetime2ts(date2),side='left')
+        else:
+            i2 = len(ts)
+        return i1,i2
+
+    # Function to locate the spots in the window [date1,date2) on a list of
+    # band codes.  Returns a slice if all bands are wanted, otherwise a
+    # time-ordered array of row numbers.
+    def window(self,date1=None,date2=None,codes=None):
+        if codes is None:
+            i1,i2 = self.span(self.ts,date1,date2)
+            return slice(i1,i2)
+
+        if self.band_rows is None:
+            self.build_index()
+        rows=[]
+        for code in codes:
+            i1,i2 = self.span(self.band_ts[code],date1,date2)
+            rows.append( self.band_rows[code][i1:i2] )
+        if len(rows)==1:
+            return rows[0]
+        else:
+            return np.sort( np.concatenate(rows) )
+
+    # Function to drop spots older than a given date
+    def since(self,date):
+        i1,i2 = self.span(self.ts,date)
+        return self.take(slice(i1,i2))
+
+    # Function to combine two stores
+    def merge(self,other):
+        builder = SpotBuilder()
+        builder.append(self)
+        builder.append(other)
+        return builder.finish()
+
+    # Function to return memory used by the spot columns
+    def nbytes(self):
+        return self.ts.nbytes + self.band.nbytes + self.lat.nbytes + self.lon.nbytes + \
+            self.snr.nbytes + self.call.nbytes + self.country.nbytes + self.needs.nbytes
+
+    # Function to test if each spot is needed for a particular selection
+    def needed(self,Need):
+        mask = need2mask(Need)
+        if mask:
+            table = (self.needs & mask) != 0
+            return table[self.country,self.band]
+        else:
+            return np.ones(len(self),dtype=bool)
+
+    # Function to reconstitute a single spot as a dict - handy for debugging
+    def spot(self,i):
+        ts = self.ts[i].astype(datetime)
+        spot = {'TimeStamp' : ts,
+                'date'      : ts.strftime('%Y-%m-%d'),
+                'time'      : ts.time(),
+                'band'      : ALL_BANDS[self.band[i]],
+                'call2'     : self.calls[self.call[i]],
+                'country'   : self.countries[self.country[i]],
+                'lat'       : float(self.lat[i]),
+                'lon'       : float(self.lon[i]),
+                'snr'       : int(self.snr[i]) }
+        need = self.needs[self.country[i],self.band[i]]
+        for j,flag in enumerate(NEED_FLAGS):
+            spot[flag] = bool(need & (1<<j))
+        return spot
+
+############################################################################################
+
+# Helper to accumulate batches of spots and then pack them into a single store
+class SpotBuilder:
+
+    def __init__(self):
+        self.chunks = []
+        self.calls  = []
+        self.countries = []
+        self.call_codes = {}
+        self.country_codes = {}
+        self.needs = empty_needs()
+
+    # Function to add a batch of spots - the string & need tables of the
+    # batch are remapped into ours
+    def append(self,spots):
+        call_map = np.array([intern(self.calls,self.call_codes,c) for c in spots.calls],
+                            dtype=np.int32)
+        country_map = np.array([intern(self.countries,self.country_codes,c)
+                                for c in spots.countries],dtype=np.int16)
+        if len(self.countries)>len(self.needs):
+            self.needs = np.concatenate(
+                [self.needs,empty_needs(len(self.countries)-len(self.needs))] )
+        self.needs[country_map] = spots.needs
+        self.chunks.append( (spots.ts,spots.band,spots.lat,spots.lon,spots.snr,
+                             call_map[spots.call],country_map[spots.country]) )
+
+    # Function to pack everything into a store and clear it.  This goes a
+    # column at a time and each column of the chunks is let go as soon as it
+    # has been copied so we never need room for two copies of all the spots.
+    def finish(self):
+        parts = list(zip(*self.chunks))
+        self.chunks = []
+
+        cols=[]
+        for j,dtype in enumerate(DTYPES):
+            if len(parts)>0:
+                cols.append( np.concatenate(parts[j]) )
+                parts[j] = None
+            else:
+                cols.append( np.array([],dtype=dtype) )
+
+        # Drop our hold on the columns so sort() can let go of each one once
+        # it has been reordered
+        spots = SpotStore(*cols,list(self.calls),list(self.countries),self.needs.copy())
+        cols = None
+        spots.sort()
+        return spots
+
+    # Function to pack everything so far into a store without clearing it,
+    # e.g. to show the spots while we're still loading.  The string & need
+    # tables are copied since they'll keep growing.  We carry on from the
+    # packed columns rather than the chunks so the snapshot shares them
+    # instead of being a second copy of everything.
+    def snapshot(self):
+        spots = self.finish()
+        self.chunks = [(spots.ts,spots.band,spots.lat,spots.lon,spots.snr,
+                        spots.call,spots.country)]
+        return spots
@@ -0,0 +1,373 @@
+############################################################################################
+#
+# spot_window.py - Rev 1.0
+# Copyright (C) 2021 by Joseph B. Attili, aa2il AT arrl DOT net
+#
+# Routines to select the spots in a time window and get them ready to plot.
+#
+# Notes:
+# - Nothing in here touches the gui so prepare_window() can be run in a
+#   worker thread.
+# - WindowCache keeps the last few prepared windows so stepping back & forth
+#   in time is just a lookup once the neighbouring windows have been
+#   prepared ahead of time.
+# - In density mode the spots on each band are binned into Maidenhead
+#   squares (2 deg lon x 1 deg lat) and we plot one marker per square
+#   sized by the number of spots in it.  This way the drawing time depends
+#   on the number of squares heard, not the number of spots.
+# - Otherwise, the spots in a window are collapsed to one per station on
+#   each band since a station heard every 15 sec would just pile up
+#   markers at the same spot.  We keep the best SNR, the number of spots
+#   and the first & last time heard.
+#
+############################################################################################
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+############################################################################################
+
+import time
+import logging
+import numpy as np
+import threading
+from collections import OrderedDict
+from spot_store import ALL_BANDS, band2code
+from instrument import logger, timer, count, add_time
+
+############################################################################################
+
+# Bands we plot
+BANDS=['160m','80m','40m','30m','20m','17m','15m','12m','10m','6m']
+BAND_CODES=[band2code(b) for b in BANDS]
+
+ALPHA=0.7
+#COLORS=['r','g','b','k','m','y','c','r','g','b','k','m','y','c']
+COLORS=['lime','magenta','blue','green','salmon','yellow',\
+        'orange','brown','purple','red']
+
+# Display modes - one marker per spot or per grid square
+SPOTS='Spots'
+DENSITY='Density'
+MODES=[SPOTS,DENSITY]
+
+# Size of grid squares for density mode (deg) - same as Maidenhead squares
+GRID_LON=2.
+GRID_LAT=1.
+
+############################################################################################
+
+# Function to generate list of DXCCs seen in list of spots
+def count_dxccs(spot_list):
+    dxccs = [spot_list.countries[c] for c in np.unique(spot_list.country)]
+    return dxccs
+
+
+# Function to select spots based on band, date, "need", etc.
+def filter_spots(spots,date1=None,date2=None,band=None,Need=None):
+
+    logger.debug('Selecting spots ... %s %s %s %s',date1,date2,band,Need)
+    if not band:
+        bands=BANDS
+    elif type(band)==list:
+        bands=band
+    else:
+        bands=[band]
+    codes = [band2code(b) for b in bands]
+
+    # Use the time index to pull out the window, then apply need filter
+    with timer('filter'):
+        spots2 = spots.take( spots.window(date1,date2,codes) )
+        if Need!='ALL SPOTS':
+            spots2 = spots2.take( spots2.needed(Need) )
+    count('filter',len(spots2))
+
+    return spots2
+
+
+# Function to summarize a spot list - the times & SNRs of each call heard
+# on each band.  Returns the text of the summary.
+def format_summary(spots):
+
+    if False:
+        #print spots2
+        for i in range(len(spots)):
+            spot=spots.spot(i)
+            print(spot['date'],spot['time'],spot['band'],\
+                '\t',spot['call2'],'\t',spot['country'],\
+                '\t',spot['snr'])
+
+    if len(spots)==0:
+        return ''
+
+    # Format all the times at once
+    times = [t[11:16] for t in np.datetime_as_string(spots.ts,unit='m')]
+    snrs  = [str(snr).rjust(3,' ') for snr in spots.snr.tolist()]
+
+    lines=[]
+    band=None
+    order,starts,ends = group_spots(spots)
+    for i1,i2 in zip(starts,ends):
+        idx = order[i1:i2]
+        j = idx[0]
+        if spots.band[j]!=band:
+            band = spots.band[j]
+            lines.append(ALL_BANDS[band]+':\n')
+        call    = spots.calls[spots.call[j]]
+        country = spots.countries[spots.country[j]]
+        #snrs = [x['snr'] for x in spots if x['call2']==call]
+        lines.append('{:8.8} : {:15.15} : {:4d} spots, best {:3d} dB, {}-{} : \n {}\n'.format(
+            call,country,len(idx),spots.snr[idx].max(),times[idx[0]],times[idx[-1]],
+            [times[k]+' '+snrs[k] for k in idx]))
+    return ''.join(lines)
+
+
+# Function to compute number of spots, DXCCs and slots in a window.  These
+# come from the histogram cube if the window lines up with its bins.
+def window_stats(spots,cube,date1,date2,Need,bands=BANDS):
+
+    if cube:
+        stats = cube.window_stats(date1,date2,Need,[band2code(b) for b in bands])
+        if stats is not None:
+            return stats
+
+    spots2 = filter_spots(spots,date1,date2,band=bands,Need='ALL SPOTS')
+    spots3 = filter_spots(spots,date1,date2,band=bands,Need=Need)
+    dxccs = count_dxccs(spots3)
+    logger.debug('dxccs= %s',dxccs)
+
+    nslots = 0
+    for band in bands:
+        spots3 = filter_spots(spots,date1,date2,band=band,Need=Need)
+        nslots += len( count_dxccs(spots3) )
+
+    return len(spots2),len(dxccs),nslots
+
+############################################################################################
+
+# Everything we need to plot a window
+class WindowData:
+
+    def __init__(self,date1,date2,Need,mode=SPOTS):
+        self.date1  = date1
+        self.date2  = date2
+        self.needed = Need
+        self.mode   = mode
+        self.x      = []                 # Per-band marker positions & sizes
+        self.y      = []
+        self.size   = []
+        self.counts   = []               # Per-band number of spots & best SNR for
+        self.snr_max  = []               # each station (or grid square in density mode)
+        self.snr_mean = []
+        self.first    = []               # Per-band first & last time each station heard
+        self.last     = []
+        self.nspots = 0
+        self.ndxcc  = 0
+        self.nslots = 0
+        self.summary = None              # Summary of the needed spots, if asked for
+
+
+# Function to group spots by band & call with one sort.  Returns the sort
+# order and where each group starts & ends in it.  The spots are in time
+# order and the sort is stable so they stay that way within each group.
+def group_spots(spots):
+    key    = spots.band.astype(np.int64)*len(spots.calls) + spots.call
+    order  = np.argsort(key,kind='stable')
+    starts = np.flatnonzero( np.diff(key[order],prepend=-1) )
+    ends   = np.append(starts[1:],len(order))
+    return order,starts,ends
+
+
+# Function to collapse spots down to one per station on each band.  Returns
+# a store with the first spot from each station, in time order, with its
+# SNR replaced by the best one and its location by the last one, along
+# with the number of spots and the first & last time for each station.
+def dedup_spots(spots):
+
+    if len(spots)==0:
+        return spots,np.zeros(0,dtype=np.int64),spots.ts,spots.ts
+
+    order,starts,ends = group_spots(spots)
+    counts  = ends-starts
+    snr_max = np.maximum.reduceat(spots.snr[order],starts)
+    first   = spots.ts[order[starts]]
+    last    = spots.ts[order[ends-1]]
+
+    # Put the stations in the order they were first heard
+    rows = order[starts]
+    perm = np.argsort(rows,kind='stable')
+    stations = spots.take(rows[perm])
+    stations.snr = snr_max[perm]
+    stations.lat = spots.lat[order[ends-1]][perm]
+    stations.lon = spots.lon[order[ends-1]][perm]
+    return stations,counts[perm],first[perm],last[perm]
+
+
+# Function to bin spots into grid squares.  Returns the lon & lat of the
+# center of each square with spots in it, the number of spots and the max
+# & mean SNR.  Spots without a location are dropped.
+def bin_spots(lons,lats,snrs,dlon=GRID_LON,dlat=GRID_LAT):
+
+    nlon = int(round(360./dlon))
+    nlat = int(round(180./dlat))
+    ok   = np.isfinite(lons) & np.isfinite(lats)
+    ix   = np.clip( ((lons[ok]+180.)//dlon).astype(np.int32), 0, nlon-1)
+    iy   = np.clip( ((lats[ok]+90.)//dlat).astype(np.int32), 0, nlat-1)
+    snr  = snrs[ok].astype(np.float32)
+
+    cells,inv,counts = np.unique(iy*nlon+ix,return_inverse=True,return_counts=True)
+    snr_max = np.full(len(cells),-128.,dtype=np.float32)
+    np.maximum.at(snr_max,inv,snr)
+    snr_mean = np.bincount(inv,weights=snr,minlength=len(cells))/np.maximum(counts,1)
+
+    lon = (cells%nlon + 0.5)*dlon - 180.
+    lat = (cells//nlon + 0.5)*dlat - 90.
+    return lon,lat,counts,snr_max,snr_mean
+
+
+# Function to select the spots in a window and work out where to put them.
+# proj converts lon/lat to map coords.  If summary is set, a summary of the
+# needed spots goes along with the window to be written out when it's shown.
+def prepare_window(spots,cube,date1,date2,Need,proj,summary=False,bands=BANDS,mode=SPOTS):
+
+    t0 = time.perf_counter()
+    data = WindowData(date1,date2,Need,mode)
+    data.nspots,data.ndxcc,data.nslots = window_stats(spots,cube,date1,date2,Need,bands)
+    if summary and Need!='ALL SPOTS':
+        data.summary = format_summary(filter_spots(spots,date1,date2,band=bands,Need=Need))
+
+    # make size of markers proportional to SNR
+    ymax = 100.
+    ymin = 10.
+    xmax = 0.
+    xmin = -25.
+    slope = (ymax - ymin) / (xmax-xmin)
+    offset = ymin - slope*xmin
+
+    # Loop over all the bands
+    for band in bands:
+        spots3 = filter_spots(spots,date1,date2,band=band,Need=Need)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('dxccs= %s',count_dxccs(spots3))
+
+        lats = spots3.lat
+        lons = spots3.lon
+        #size  = [slope*s['snr']+offset for s in spots3]
+        if mode==DENSITY:
+            # One marker per grid square - 20 for a single spot growing by
+            # 100 for each factor of 10, up to 300
+            lons,lats,counts,snr_max,snr_mean = bin_spots(lons,lats,spots3.snr)
+            size = np.minimum(20.+100.*np.log10(counts),300.)
+            data.counts.append(counts)
+            data.snr_max.append(snr_max)
+            data.snr_mean.append(snr_mean)
+        elif Need=='New DXCCs' and False:
+            size = np.full(len(spots3),100.)
+        else:
+            # One marker per station sized by its best SNR
+            stations,counts,first,last = dedup_spots(spots3)
+            lats = stations.lat
+            lons = stations.lon
+            size = slope*stations.snr.astype(np.float32)+offset
+            data.counts.append(counts)
+            data.snr_max.append(stations.snr)
+            data.first.append(first)
+            data.last.append(last)
+
+        x, y = proj(lons,lats)
+        data.x.append(x)
+        data.y.append(y)
+        data.size.append(size)
+
+    add_time('window',time.perf_counter()-t0)
+    return data
+
+# Function to create a scatter for each band - the spots are plotted by
+# just updating their data
+def create_scatters(m,ax,bands=BANDS):
+    lines=[]
+    for band in bands:
+        i = BANDS.index(band)
+        line = m.scatter(np.zeros(0),np.zeros(0),marker='o',
+                         c=COLORS[i], edgecolors=COLORS[i],
+                         s=50,alpha=ALPHA,label=band)
+        lines.append(line)
+    ax.legend(loc='lower center',fontsize='small',\
+              ncol=len(lines),scatterpoints=1)
+    return lines
+
+# Function to plot a prepared window on the band scatters
+def update_scatters(lines,data):
+    for i in range(len(lines)):
+        if i<len(data.x):
+            lines[i].set_offsets( np.column_stack((data.x[i],data.y[i])) )
+            lines[i].set_sizes(data.size[i])
+        else:
+            lines[i].set_offsets( np.zeros((0,2)) )
+
+############################################################################################
+
+# Bounded cache of prepared windows
+class WindowCache:
+
+    def __init__(self,max_size=16):
+        self.max_size = max_size
+        self.windows  = OrderedDict()
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+    # Function to get a prepared window, None if we don't have it
+    def get(self,date1,date2,Need,mode=SPOTS,count=True):
+        key = (date1,date2,Need,mode)
+        with self.lock:
+            data = self.windows.get(key)
+            if data is None:
+                self.misses += count
+            else:
+                self.windows.move_to_end(key)
+                self.hits += count
+        return data
+
+    # Function to see if we have a window without counting it as a lookup
+    def have(self,date1,date2,Need,mode=SPOTS):
+        with self.lock:
+            return (date1,date2,Need,mode) in self.windows
+
+    # Function to add a window to the cache, dropping the oldest if it's full
+    def put(self,data):
+        key = (data.date1,data.date2,data.needed,data.mode)
+        with self.lock:
+            self.windows[key] = data
+            self.windows.move_to_end(key)
+            while len(self.windows)>self.max_size:
+                self.windows.popitem(last=False)
+
+    # Function to throw away windows that end after date, e.g. when new
+    # spots come in
+    def drop_after(self,date):
+        with self.lock:
+            for key in list(self.windows.keys()):
+                if key[1]>date:
+                    del self.windows[key]
+
+    # Function to throw away windows that depend on the need flags
+    def drop_needed(self):
+        with self.lock:
+            for key in list(self.windows.keys()):
+                if key[2]!='ALL SPOTS':
+                    del self.windows[key]
+
+    def hit_rate(self):
+        n = self.hits+self.misses
+        if n==0:
+            return 0.
+        else:
+            return float(self.hits)/n
@@ -25,38 +25,44 @@
 ############################################################################################
 
 import sys
+import os
+import json
+import argparse
 from PyQt5.QtWidgets import *
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
 
-from time import sleep
 from datetime import timedelta,datetime
-from pytz import timezone
 
+# The dx.spot_processing stuff (challenge data, etc.), pytz and Basemap are
+# imported when we need them so the gui comes up quickly
 from dx.wsjt_helper import *
-from dx.cluster_connections import *
-from dx.spot_processing import Station, Spot, WWV, Comment, ChallengeData
-from pprint import pprint
-
-# JBA - this fixes a bug? in mpl_toolkits
-# It appears that basemaps (& python 2.7) are about to become obsolete so
-# it is time to start looking for an alternative.
-from matplotlib.backends.qt_compat import QtCore, QtWidgets
-import matplotlib.pyplot as plt
+
+from matplotlib.backends.qt_compat import QtCore
 from matplotlib.figure import Figure
+from matplotlib.collections import Collection
+from matplotlib.contour import ContourSet
 
-import mpl_toolkits
-mpl_toolkits.__path__.append('/usr/lib/python2.7/dist-packages/mpl_toolkits/')
-from mpl_toolkits.basemap import Basemap
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
 import numpy as np
-from itertools import chain
-import cProfile
+from itertools import chain, islice
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import time 
 from settings import read_settings
+from spot_store import SpotStore, SpotBuilder, ALL_BANDS, band2code
+from spot_cache import load_cache, save_cache
+from all_txt import start_read, read_chunks, split_file, band_batches, file_state, CHUNK_SIZE
+from dxcc_cache import DxccResolver
+from spot_cube import SpotCube
+from map_background import CylMap, import_basemap
+from instrument import logger, timer, count, add_time, report, setup_logging, LEVELS, \
+    start_profile, stop_profile, start_memory, memory_snapshot
+from spot_window import BANDS, ALPHA, \
+    prepare_window, WindowData, WindowCache, create_scatters, update_scatters, SPOTS, DENSITY, MODES
 
 ############################################################################################
 
-BANDS=['160m','80m','40m','30m','20m','17m','15m','12m','10m','6m']
 LOGFILE = WSJT_LOGFILE
 LOGFILE = WSJT_LOGFILE2
 
@@ -66,51 +72,215 @@ LOGFILE = WSJT_LOGFILE5
 
 LOGFILE = [WSJT_LOGFILE3,WSJT_LOGFILE4,WSJT_LOGFILE5]
 MAX_DAYS=7
-
-ALPHA=0.7
+CACHE_FILE='spots.npz'
+NEEDED_FILE='needed.csv'
+NEEDED_FLAG='New Slots'          # What counts as needed for NEEDED_FILE
+EXPORTED_FILE='needed.json'      # How far into each log file NEEDED_FILE goes
+NUM_WORKERS=os.cpu_count()
+POLL_SECS=15
+PROGRESS_SECS=2
+QUERY_PORT=8073
+MP_START='forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
 
 ############################################################################################
 
-def freq2band(frq_KHz):
-
-    frq = .001*frq_KHz
-    if frq<3:
-        band=160
-    elif frq<5:
-        band=80
-    elif frq<6:
-        band=60
-    elif frq<9:
-        band=40
-    elif frq<12:
-        band=30
-    elif frq<16:
-        band=20
-    elif frq<20:
-        band=17
-    elif frq<23:
-        band=15
-    elif frq<27:
-        band=12
-    elif frq<40:
-        band=10
-    else:
-        band=6
+# Signals to pass a prepared window & news of new spots back to the gui thread
+class WorkerSignals(QObject):
+    ready   = pyqtSignal(int,object)
+    tailed  = pyqtSignal(int,object)
+    loading = pyqtSignal(object,int,int)
+    loaded  = pyqtSignal(object,object,object)
+    needs   = pyqtSignal()
+
+
+# Worker to select the spots for a window off the gui thread.  Prefetched
+# windows just go into the cache.
+class WindowWorker(QRunnable):
+
+    def __init__(self,gui,rid,date1,date2,Need,mode=SPOTS,prefetch=False):
+        super(WindowWorker, self).__init__()
+        self.gui      = gui
+        self.rid      = rid
+        self.date1    = date1
+        self.date2    = date2
+        self.Need     = Need
+        self.mode     = mode
+        self.prefetch = prefetch
+
+    def run(self):
+
+        # An exception here would take the whole gui down so plot an empty
+        # window instead
+        try:
+            self.select()
+        except Exception:
+            logger.exception('Unable to select spots for %s %s',self.date1,self.date2)
+            if not self.prefetch:
+                data = WindowData(self.date1,self.date2,self.Need,self.mode)
+                self.gui.signals.ready.emit(self.rid,data)
+
+    # Function to select the spots & pass them back to the gui
+    def select(self):
+        gui = self.gui
+
+        # The spots can be swapped out from under us while they're loading
+        # so hang on to the ones we start with
+        spots,cube,windows = gui.spots,gui.cube,gui.windows
+        if self.prefetch:
+            if not windows.have(self.date1,self.date2,self.Need,self.mode):
+                data = prepare_window(spots,cube,self.date1,self.date2,self.Need,gui.m,
+                                      gui.summary is not None,mode=self.mode)
+                windows.put(data)
+            return
+
+        if self.rid!=gui.request_id:
+            return
+        data = windows.get(self.date1,self.date2,self.Need,self.mode,count=False)
+        if data is None:
+            data = prepare_window(spots,cube,self.date1,self.date2,self.Need,gui.m,
+                                  gui.summary is not None,mode=self.mode)
+            windows.put(data)
+        gui.signals.ready.emit(self.rid,data)
+
+
+# Worker to pick up new spots from the log files.  This runs in the same
+# single thread as the window workers so they never see the store change
+# under them.
+class TailWorker(QRunnable):
+
+    def __init__(self,gui):
+        super(TailWorker, self).__init__()
+        self.gui = gui
+
+    def run(self):
+        gui = self.gui
+
+        # An exception here would take the whole gui down, e.g. if a log
+        # file is rotated while we're reading it, so just try again next time
+        try:
+            spots,new_spots = tail_spots(gui.spots,gui.files,gui.resolver,gui.export)
+        except Exception:
+            logger.exception('Unable to read new spots')
+            gui.signals.tailed.emit(0,None)
+            return
+        if new_spots is None:
+            return
+
+        # Swap in the new spots & throw away any windows they change.  The
+        # cube only takes a few tens of ms to rebuild.
+        gui.spots = spots
+        gui.cube  = SpotCube(spots)
+        gui.windows.drop_after(new_spots.ts[0].astype(datetime))
+        gui.signals.tailed.emit(len(new_spots),new_spots.ts[-1].astype(datetime))
+
+
+# Worker to work out the need flags again after the challenge data has been
+# updated or slots have been marked as worked.  Only the (country,band) need
+# table is redone - the spots stay as they are.  This runs in the same single
+# thread as the window workers too.
+class NeedsWorker(QRunnable):
+
+    def __init__(self,gui):
+        super(NeedsWorker, self).__init__()
+        self.gui = gui
+
+    def run(self):
+        gui = self.gui
+
+        # Pick up everything that has been asked for so far
+        reload,gui.reload_needs = gui.reload_needs,False
+        worked,gui.worked_slots = gui.worked_slots,[]
+        if not reload and len(worked)==0:
+            return
 
-    return str(band)+'m'
+        try:
+            if reload:
+                gui.resolver.reload( load_challenge_data(gui.states_file) )
+            for country,band in worked:
+                gui.resolver.mark_worked(country,band)
+            with timer('needs'):
+                needs = gui.resolver.need_table(gui.spots.countries)
+        except Exception:
+            # Put everything back so it's tried again next time, e.g. if
+            # states.xls was still being saved
+            logger.exception('Unable to update need flags')
+            gui.reload_needs = gui.reload_needs or reload
+            gui.worked_slots = worked + gui.worked_slots
+            return
 
+        # Swap in the new table & throw away any windows it changes
+        gui.spots = gui.spots.with_needs(needs)
+        gui.cube.set_needs(needs)
+        gui.windows.drop_needed()
+        gui.signals.needs.emit()
+
+
+# Worker to read the challenge data & load the spots in the background.  The
+# spots read so far are passed back to the gui every so often so they can
+# be plotted while we're still reading.
+class LoadWorker(QRunnable):
+
+    def __init__(self,gui,states_file,export=True):
+        super(LoadWorker, self).__init__()
+        self.gui         = gui
+        self.states_file = states_file
+        self.export      = export
+        self.last        = 0
+
+    def run(self):
+        try:
+            # The challenge data is only needed once we get around to
+            # enriching new spots so read it while we read the cache
+            with ThreadPoolExecutor(max_workers=1) as ex:
+                chdata   = ex.submit(load_challenge_data,self.states_file)
+                resolver = DxccResolver(chdata)
+                spots,files = load_spots(self.states_file,resolver,self.progress,
+                                         self.export)
+        except Exception:
+            logger.exception('Unable to load spots')
+            return
+        self.gui.signals.loaded.emit(spots,files,resolver)
+
+    # Callback from load_spots with the spots so far
+    def progress(self,builder,done,total):
+        now = time.time()
+        if now-self.last<PROGRESS_SECS:
+            return
+        self.last = now
+        self.gui.signals.loading.emit(builder.snapshot(),done,total)
 
 
 class WSMAP_GUI(QMainWindow):
 
-    def __init__(self, spots,parent=None):
+    def __init__(self, spots,summary=None,parent=None):
         super(WSMAP_GUI, self).__init__(parent)
 
         print('\nInit GUI ...\n')
         self.spots=spots
-        self.count=0
+        self.summary=summary
+        self.cube=SpotCube(spots)
         self.lines=[]
         self.t1='0000'
+
+        # Spots for each window are selected in a worker thread - only one
+        # at a time so a new request just replaces any that are waiting
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.request_id = 0
+        self.signals = WorkerSignals()
+        self.signals.ready.connect(self.WindowReady)
+        self.signals.tailed.connect(self.SpotsAdded)
+        self.signals.loading.connect(self.SpotsLoading)
+        self.signals.loaded.connect(self.SpotsLoaded)
+        self.signals.needs.connect(self.NeedsChanged)
+        self.loader = QThreadPool()
+        self.following = False
+        self.export = False
+        self.resolver = None
+        self.states_file = None
+        self.reload_needs = False
+        self.worked_slots = []
+        self.windows = WindowCache()
         
         # Start by putting up the root window
         self.win  = QWidget()
@@ -151,8 +321,11 @@ class WSMAP_GUI(QMainWindow):
                                  QSizePolicy.MinimumExpanding)
         self.canv.setSizePolicy(sizePolicy)
 
-        # Draw the map
+        # Draw the map & start working out the night shading for the spots we have
         self.draw_map()
+        if isinstance(self.m,CylMap) and len(spots)>0:
+            self.m.night_cache.prefetch(spots.ts[0].astype(datetime),
+                                        spots.ts[-1].astype(datetime))
 
         # User selections
         row=0
@@ -184,6 +357,19 @@ class WSMAP_GUI(QMainWindow):
         self.grid.addWidget(self.select_cb,row+4,ncols-1)
         self.needed='ALL SPOTS'
 
+        self.worked_btn = QPushButton('Worked ...')
+        self.worked_btn.setToolTip('Click to mark a slot as worked')
+        self.worked_btn.clicked.connect(self.MarkWorked)
+        self.worked_btn.setEnabled(False)
+        self.grid.addWidget(self.worked_btn,row+4,ncols-2)
+
+        # Plot each spot or the number of spots in each grid square
+        self.mode=SPOTS
+        self.mode_cb = QComboBox()
+        self.mode_cb.addItems(MODES)
+        self.mode_cb.currentIndexChanged.connect(self.Mode_Selection)
+        self.grid.addWidget(self.mode_cb,row+3,ncols-1)
+
         # Status Boxes
         self.date1a = QLabel()
         self.date1a.setAlignment(QtCore.Qt.AlignCenter)
@@ -221,6 +407,12 @@ class WSMAP_GUI(QMainWindow):
         self.grid.addWidget(self.num_slots,row+2,ncols-1)
         self.num_slots.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
 
+        # Progress of spot loading
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.hide()
+        self.statusBar().addPermanentWidget(self.progress)
+
         # Let's roll!
         self.show()
         
@@ -242,6 +434,12 @@ class WSMAP_GUI(QMainWindow):
         print('Spot Selection: idx=',idx,'\t',self.needed)
         self.UpdateMap()
 
+    # Function to select display mode
+    def Mode_Selection(self,idx):
+        self.mode=MODES[idx]
+        print('Display Mode: idx=',idx,'\t',self.mode)
+        self.UpdateMap()
+
     # Function to advance in time
     def Advance(self):
         print('\nAdvance:',self.dT)
@@ -291,37 +489,12 @@ class WSMAP_GUI(QMainWindow):
         
         self.UpdateMap()
         
-    # Function to print summary of spot list
-    def print_summary(self,spots):
-
-        if False:
-            #print spots2
-            for i in range(len(spots2)):
-                #print spots2[i]
-                print(spots2[i]['date'],spots2[i]['time'],spots2[i]['band'],\
-                    '\t',spots2[i]['call2'],'\t',spots2[i]['country'],\
-                    '\t',spots2[i]['snr'])
-
-        calls = list(set( [x['call2'] for x in spots] ))
-        #print ' ' #calls
-        for call in calls:
-            dx = Station(call)
-            #snrs = [x['snr'] for x in spots if x['call2']==call]
-            snrs=[]
-            for x in spots:
-                if x['call2']==call:
-                    t=x['time'].strftime('%H:%M')
-                    snr=str(x['snr']).rjust(3,' ')
-                    snrs.append( t+' '+snr )
-            #print '{0: <8}'.format(call),':','{0: <10}'.format(dx.country),':',snrs
-            print('{:8.8} : {:15.15} :'.format(call,dx.country),'\n',snrs)
-
-            
-
     # Function to draw spots on the map
     def UpdateMap(self):
         
         # Update Gui
+        import pytz
+        from pytz import timezone
         fmt = "%m/%d %H:%M %Z"
         date1 = pytz.utc.localize( self.date1 )
         date2 = pytz.utc.localize( self.date2 )
@@ -335,102 +508,195 @@ class WSMAP_GUI(QMainWindow):
 
         self.cal.setSelectedDate(date1)
 
-        # Clear the current spots
-        self.count+=1
-        if self.count>1:
-            print('Clearing canvas...',self.count)
-            for i in range(len(BANDS)):
-                self.lines[i].remove()
-            self.canv.draw()
-            print('... Canvas cleared.')
+        # Hand the spot selection off to a worker thread so the gui stays
+        # responsive.  Anything still waiting in the queue is out of date.
+        # If we already have this window, just plot it.
+        self.request_id += 1
+        self.pool.clear()
+        if self.reload_needs or len(self.worked_slots)>0:
+            self.pool.start(NeedsWorker(self),2)
+        data = self.windows.get(self.date1,self.date2,self.needed,self.mode)
+        if data is not None:
+            self.WindowReady(self.request_id,data)
+        else:
+            worker = WindowWorker(self,self.request_id,self.date1,self.date2,self.needed,
+                                  self.mode)
+            self.pool.start(worker,1)
 
-        # Shade the night areas
-        if self.count>1:
-            for item in self.CS.collections:
+
+    # Slot called when a worker has the spots for a window ready to plot
+    def WindowReady(self,rid,data):
+        if rid!=self.request_id:
+            logger.debug('Discarding stale window %s %s',data.date1,data.date2)
+            return
+
+        # Shade the night areas - the cached map updates its shading in place
+        t0 = time.perf_counter()
+        old = self.night_artists()
+        self.CS=self.m.nightshade(data.date1,alpha=0.2)
+        for item in old:
+            if item not in self.night_artists():
                 item.remove()
-        self.CS=self.m.nightshade(self.date1,alpha=0.2)
-
-        # make size of markers proportional to SNR
-        ymax = 100.
-        ymin = 10.
-        xmax = 0.
-        xmin = -25.
-        slope = (ymax - ymin) / (xmax-xmin)
-        offset = ymin - slope*xmin
-
-        # Loop over all the bands
-        #colors=['r','g','b','k','m','y','c','r','g','b','k','m','y','c']
-        colors=['lime','magenta','blue','green','salmon','yellow',\
-                'orange','brown','purple','red']
-        spots2 = filter_spots(self.spots,self.date1,self.date2,Need='ALL SPOTS')
-        spots3 = filter_spots(self.spots,self.date1,self.date2,Need=self.needed)
-        dxccs = count_dxccs(spots3)
-        print('dxccs=',dxccs)
-        self.num_spots.setText( ('%d Spots' % len(spots2)) )
-        self.num_dxcc.setText( ('%d DXCCs' % len(dxccs)) )
-
-        nslots = 0
-        for i in range(len(BANDS)):
-            spots3 = filter_spots(spots2,band=BANDS[i],Need=self.needed)
-            nslots += len( count_dxccs(spots3) )
-            self.num_slots.setText( ('%d Slots' % nslots) )
-            dxccs2 = count_dxccs(spots3)
-            print('dxccs=',dxccs2)
-            if self.needed!='ALL SPOTS':
-                self.print_summary(spots3)
-
-            lats = [x['lat'] for x in spots3]
-            lons = [x['lon'] for x in spots3]
-            #size  = [slope*s['snr']+offset for s in spots3]
-            size=[]
-            for s in spots3:
-                if self.needed=='New DXCCs' and False:
-                    size .append( 100 )
-                else:
-                    size .append( slope*s['snr']+offset )
-
-            if False:
-                # These corrections are needed if/when we use the miller projection in basemap
-                for j in range(len(lats)):
-                    if lats[j] is None:
-                        lats[j]=0.
-                        size[j]=1
-                    else:
-                        lats[j]=float(lats[j])
-                    if lons[j] is None:
-                        lons[j]=0.
-                        size[j]=1
-                    else:
-                        lons[j]=float(lons[j])
-
-                #print lats
-                #print lons
-
-            x, y = self.m(lons,lats)
-
-            if True:
-                line = self.m.scatter(x,y,marker='o', c=colors[i], edgecolors=colors[i],\
-                                      s=size,alpha=ALPHA, \
-                                      label=BANDS[i])
-            else:
-                line = self.m.scatter(lons,lats,latlon=True,
-                                      marker='o', c=colors[i], 
-                                      s=size,alpha=ALPHA, 
-                                      label=BANDS[i])
-            if self.count==1:
-                self.lines.append(line)
-            else:
-                self.lines[i]=line
+        for item in self.night_artists():
+            item.set_animated(True)
+
+        # Update counts
+        self.num_spots.setText( ('%d Spots' % data.nspots) )
+        self.num_dxcc.setText( ('%d DXCCs' % data.ndxcc) )
+        self.num_slots.setText( ('%d Slots' % data.nslots) )
+
+        # Update the scatter for each band in place
+        update_scatters(self.lines,data)
+        if self.summary and data.summary:
+            self.summary.write(data.summary)
+            self.summary.flush()
 
         # refresh canvas
-        self.canv.draw()
-                
-        if self.count==1:
-            self.ax.legend(loc='lower center',fontsize='small',\
-                           ncol=len(self.lines),scatterpoints=1)
+        self.blit()
+        add_time('draw',time.perf_counter()-t0)
+        logger.debug('Window cache: %d hits, %d misses, hit rate %.0f%%',
+                     self.windows.hits,self.windows.misses,100.*self.windows.hit_rate())
+
+        # Chances are the user will step forward or back next so get those
+        # windows ready while they are looking at this one
+        dT = data.date2-data.date1
+        for sgn in [1,-1]:
+            date1 = data.date1+sgn*dT
+            worker = WindowWorker(self,self.request_id,date1,date1+dT,data.needed,
+                                  data.mode,True)
+            self.pool.start(worker,0)
+
+    # Function to load the spots in the background.  If follow is set, we
+    # keep reading new spots once they're loaded.
+    def load(self,states_file,follow=False,export=True):
+        self.following = follow
+        self.export = export
+        self.states_file = states_file
+        self.progress.setValue(0)
+        self.progress.show()
+        self.statusBar().showMessage('Loading spots ...')
+        self.loader.start(LoadWorker(self,states_file,export))
+
+    # Function to swap in a new set of spots
+    def set_spots(self,spots):
+        self.spots   = spots
+        self.cube    = SpotCube(spots)
+        self.windows = WindowCache()
+
+    # Slot called with the spots read so far
+    def SpotsLoading(self,spots,done,total):
+        if total>0:
+            self.progress.setValue( int(100*done/total) )
+        self.statusBar().showMessage('Loading spots ... %d so far' % len(spots))
+        self.set_spots(spots)
+        self.UpdateMap()
 
+    # Slot called when all the spots have been loaded
+    def SpotsLoaded(self,spots,files,resolver):
+        self.progress.hide()
+        self.statusBar().showMessage('Loaded %d spots' % len(spots),10000)
+        self.set_spots(spots)
+        report()
+        memory_snapshot('after loading spots')
+        if isinstance(self.m,CylMap) and len(spots)>0:
+            self.m.night_cache.prefetch(spots.ts[0].astype(datetime),
+                                        spots.ts[-1].astype(datetime))
+        self.resolver = resolver
+        self.worked_btn.setEnabled(True)
+        self.watch_states()
+        if self.following:
+            self.follow(files)
+        self.UpdateMap()
 
+    # Function to keep reading new spots from the log files as they come in
+    def follow(self,files,interval=POLL_SECS):
+        self.files    = files
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.PollLogFiles)
+        self.timer.start(1000*interval)
+
+    # Timer callback to check the log files for new spots
+    def PollLogFiles(self):
+        self.pool.start(TailWorker(self),1)
+
+    # Slot called when new spots have been added - redraw if we're looking
+    # at the current time
+    def SpotsAdded(self,nspots,last):
+        if nspots==0:
+            return
+        print('Added',nspots,'new spots - last at',last)
+        now = datetime.utcnow()
+        if self.date1<=now<self.date2 or self.date1<=last<self.date2:
+            self.UpdateMap()
+
+    # Function to watch for changes to the challenge data
+    def watch_states(self):
+        if not self.states_file or not os.path.exists(self.states_file):
+            return
+        self.watcher = QtCore.QFileSystemWatcher([self.states_file])
+        self.watcher.fileChanged.connect(self.StatesChanged)
+
+    # Slot called when the challenge data has changed.  We give it a couple
+    # of secs to finish being written before we read it.
+    def StatesChanged(self,fname):
+        print('Challenge data',fname,'has changed')
+        if fname not in self.watcher.files() and os.path.exists(fname):
+            # Some programs replace the file rather than rewriting it
+            self.watcher.addPath(fname)
+        self.reload_needs = True
+        QtCore.QTimer.singleShot(2000,self.update_needs)
+
+    # Function to mark a slot as worked
+    def MarkWorked(self):
+        countries = sorted(self.spots.countries)
+        country,ok = QInputDialog.getItem(self,'Mark Worked','Country:',countries,0,False)
+        if not ok:
+            return
+        band,ok = QInputDialog.getItem(self,'Mark Worked','Band:',BANDS,0,False)
+        if not ok:
+            return
+        print('Marking',country,'as worked on',band)
+        self.worked_slots.append( (country,band) )
+        self.update_needs()
+
+    # Function to work out the need flags again in the background
+    def update_needs(self):
+        if self.resolver is not None:
+            self.pool.start(NeedsWorker(self),2)
+
+    # Slot called when the need flags have been updated
+    def NeedsChanged(self):
+        print('Need flags updated')
+        self.UpdateMap()
 
+    # Function to return the artists making up the night shading
+    def night_artists(self):
+        if self.CS is None:
+            return []
+        elif isinstance(self.CS,ContourSet) and not isinstance(self.CS,Collection):
+            return self.CS.collections
+        else:
+            return [self.CS]
+
+    # Callback when the whole canvas has been redrawn, e.g. when the window
+    # is resized - grab the static background so we can blit over it
+    def on_draw(self,event):
+        self.background = self.canv.copy_from_bbox(self.fig.bbox)
+        self.draw_spots()
+
+    # Function to draw the night shading and spots
+    def draw_spots(self):
+        for artist in self.night_artists()+self.lines:
+            self.ax.draw_artist(artist)
+
+    # Function to restore the background and draw the spots over it
+    def blit(self):
+        if self.background is None:
+            self.canv.draw()
+        else:
+            self.canv.restore_region(self.background)
+            self.draw_spots()
+            self.canv.blit(self.fig.bbox)
 
     
     # Draw a shaded-relief image
@@ -438,16 +704,46 @@ class WSMAP_GUI(QMainWindow):
         self.ax = self.fig.add_subplot(111)
         self.fig.tight_layout(pad=0)
 
-        lon_offset=30
         if True:
-            m = Basemap(projection='cyl', resolution='c',
-                        llcrnrlat=-90, urcrnrlat=90,
-                        llcrnrlon=-180, urcrnrlon=180,
-                        fix_aspect=False, ax=self.ax)
-            m.shadedrelief(scale=scale)
-            #m.bluemarble(scale=scale)
-            #m.etopo(scale=scale)
-        elif Fale:
+            # Cylindrical projection - put up the cached background.  It is
+            # rendered at twice the initial canvas size so it still looks
+            # ok when the window is made bigger.
+            m = CylMap(self.ax)
+            width,height = self.canv.get_width_height()
+            m.draw_background(scale,2*width,2*height,ALPHA)
+            self.m = m
+        else:
+            self.draw_basemap(scale)
+            m = self.m
+
+        # Create a scatter for each band - UpdateMap just updates their data
+        self.lines = create_scatters(m,self.ax)
+
+        # The spots & night shading are drawn on top of a static background
+        # so we don't have to redraw the whole map every time they change.
+        # This has to be done after the legend is created or the legend
+        # markers would be animated too.
+        for line in self.lines:
+            line.set_animated(True)
+        self.CS=None
+        self.background=None
+        self.canv.mpl_connect('draw_event',self.on_draw)
+
+        # discards the old graph
+        #ax.clear()
+
+        # plot data
+        #ax.plot(data, '*-')
+
+        # refresh canvas
+        #self.canvas.draw()
+
+
+    # Draw the map with Basemap for projections we don't cache
+    def draw_basemap(self,scale=0.01):
+        Basemap = import_basemap()
+
+        if False:
             # Great circle map - sort of works but grey line is hosed up
             lon_0 = -105; lat_0 = 40
             m = Basemap(projection='aeqd',lat_0=lat_0,lon_0=lon_0,
@@ -507,144 +803,330 @@ class WSMAP_GUI(QMainWindow):
         m.drawstates()
         m.drawcountries()
 
-        # discards the old graph
-        #ax.clear()
-
-        # plot data
-        #ax.plot(data, '*-')
-
-        # refresh canvas
-        #self.canvas.draw()
 
-
-# Function to load spots from ALL.TXT file
-def load_spots():
-    
-    rootlogger = "dxcsucker"
-    logger = get_logger(rootlogger)
-
-    if False:
-    #if True:
-        print('Reading spot data ...')
-        fp = open('spots.pcl','rb')
-        spots = pickle.load( fp )
-        fp.close()
-        print('... Read spot data.')
-        return spots
-
-    tn = wsjt_helper(LOGFILE,MAX_DAYS)
-    spots=tn.read_all_spots(MAX_DAYS)
-    print('size=',sys.getsizeof(spots))
-    print('size=',sys.getsizeof(spots[0]))
-
-    print('Filling out spot data ...',len(spots))
-    fp1 = open('needed.csv', 'w')
-    for i in range(len(spots)):
-        if i%100000 ==0:
-            print('i=',i,'\tlen=',len(spots))
-
-        # Look for and correct band switches while decoding
-        band = freq2band(spots[i]['freq'])
-        if i==0:
-            last_time=spots[i]['time']
-            last_band=band
-        elif spots[i]['time']==last_time and last_band!=band:
-            print('\nWhoops! Looks like a band switch during interval:')
-            #print(last_time,spots[i]['time'])
-            #print(last_band,band)
-            #print(i-1,spots[i-1])
-            #print(i,spots[i])
-            band=last_band
-            #sys.exit(0)
+# Function to return list of log files to read
+def log_files():
+    if type(LOGFILE)==list:
+        return LOGFILE
+    else:
+        return [LOGFILE]
+
+
+# Function to tell if a log file has been replaced since we last read it -
+# it has either shrunk or starts differently
+def file_replaced(state,old):
+    return state['size']<old['offset'] or not state['head'].startswith(old.get('head',''))
+
+
+# Function to see which log files we can pick up where we left off.
+# Returns True if the cached spots are still good.
+def check_log_files(fnames,files):
+
+    if sorted(files.keys())!=sorted(fnames):
+        print('List of log files has changed')
+        return False
+
+    for fname in fnames:
+        old = files[fname]
+        if not os.path.exists(fname):
+            continue
+        state = file_state(fname)
+        if file_replaced(state,old):
+            print('Log file',fname,'has been replaced')
+            return False
+
+    return True
+
+
+# Function to figure out what we need to read from each log file.  Returns
+# the files with new data along with their old & new states, and the number
+# of bytes to read.  Files with nothing new are brought up to date in files.
+def find_new_data(fnames,files):
+
+    todo={}
+    nbytes=0
+    for fname in fnames:
+        if not os.path.exists(fname):
+            print('Log file',fname,'not found')
+            continue
+        state = file_state(fname)
+        old = files.get(fname, {'offset':0,'mtime':None,'last_ts':None,'last_band':None})
+        if state['size']==old['offset'] and state['mtime']==old['mtime']:
+            logger.debug('No new spots in %s',fname)
+            state.update( {k:old[k] for k in ['offset','last_ts','last_band']} )
+            files[fname]=state
         else:
-            last_time=spots[i]['time']
-            last_band=band
-
-        # Fill in DXCC info
-        call = spots[i]['call2']
-        dx = Station(call)
-        dx.needed = chdata.needed_challenge(dx.country,band.upper(),0)
-        spots[i]['country'] = dx.country
-        spots[i]['lat'] = dx.latitude
-        lon = dx.longitude
-        if lon:
-            spots[i]['lon'] = -lon
+            todo[fname]=(state,old)
+            nbytes += state['size']-old['offset']
+
+    return todo,nbytes
+
+
+# Function to read the new data in each log file, picking up where we left
+# off.  The new spots are added to builder and files is updated.  If needed
+# is a list, the new needed spots are added to it too, e.g. to export them,
+# except for those before the offsets in exported, which already have been.
+def read_new_spots(todo,files,cutoff,resolver,builder,pool=None,progress=None,
+                   needed=None,exported={}):
+
+    # The parts of each file to read - split where we exported up to so no
+    # batch has spots from both sides of it
+    ranges={}
+    for fname,(state,old) in todo.items():
+        x = exported.get(fname,0)
+        if old['offset']<x<state['size']:
+            ranges[fname] = [(old['offset'],x),(x,None)]
         else:
-            spots[i]['lon'] = lon             # None
-        spots[i]['band'] = band
-        
-        spots[i]['New DXCCs'] = chdata.needed_challenge(dx.country,'ALL',0)
-        spots[i]['New Slots'] = dx.needed
-        spots[i]['DXCC 2021'] = chdata.needed_challenge(dx.country,2021,0)
-        #spots[i]['TimeStamp'] = datetime.strptime( spots[i]['date']+' '+spots[i]['time'],
-        #"%Y-%m-%d %H%M%S") 
-
-        if i==0:
-            print('First Spot:',spots[0])
-            print('dx=',pprint(vars(dx)))
-            print('size=',sys.getsizeof(spots))
-            print('size=',sys.getsizeof(spots[0]),sys.getsizeof(dx))
-
-        if dx.needed:
-            fp1.write('%s,%s,%s,%s,%s,%s\n' % \
-                      ( spots[i]['date'], spots[i]['time'],   spots[i]['band'],\
-                        spots[i]['call2'],spots[i]['country'],spots[i]['snr'] ) )
-            fp1.flush()
+            ranges[fname] = [(old['offset'],None)]
+
+    # If there is a pool, the files are split into chunks which are farmed
+    # out to it.  Otherwise, the spots are streamed in batches as they are read.
+    jobs={}
+    if pool:
+        chunks = [(fname,start,end) for fname in todo for s,e in ranges[fname]
+                  for start,end in split_file(fname,s,e)]
+        batches = read_chunks(pool,chunks,cutoff,NUM_WORKERS)
+        for fname in todo:
+            nchunks = len([c for c in chunks if c[0]==fname])
+            jobs[fname] = islice(batches,nchunks)
+    else:
+        for fname in todo:
+            jobs[fname] = chain(*[start_read(fname,s,cutoff,e) for s,e in ranges[fname]])
+
+    # Keep track of how far along we are for the progress callback
+    nbytes = sum([state['size']-old['offset'] for state,old in todo.values()])
+    done=0
+
+    # Stream the new spots through band fix-up and DXCC enrichment into the
+    # columnar store a batch at a time
+    total=0
+    for fname,(state,old) in todo.items():
+        if old['last_ts']:
+            last_ts   = np.datetime64(old['last_ts'],'s')
+            last_code = band2code(old['last_band'])
+        else:
+            last_ts   = None
+            last_code = None
+        state['offset'] = old['offset']
+
+        logger.info('Filling out spot data ... %s',fname)
+        t0 = time.perf_counter()
+        nspots=0
+        for (ts,band,snr,call,grid,calls),offset in \
+            band_batches(jobs.pop(fname),last_ts,last_code):
+
+            # Fill in DXCC info & locations
+            with timer('enrich'):
+                new_spots = resolver.enrich(ts,band,snr,call,grid,calls,cutoff)
+            count('enrich',len(new_spots))
+            if nspots==0 and len(new_spots)>0:
+                logger.debug('First Spot: %s',new_spots.spot(0))
+            nspots += len(new_spots)
+            logger.debug('nspots= %d',nspots)
+
+            builder.append(new_spots)
+            if needed is not None and offset>exported.get(fname,0):
+                needed.append( new_spots.take(new_spots.needed(NEEDED_FLAG)) )
+
+            # Remember where we left off
+            done += offset-state['offset']
+            state['offset'] = offset
+            if len(ts)>0:
+                last_ts   = ts[-1]
+                last_code = band[-1]
+            if progress:
+                progress(builder,done,nbytes)
+
+        if last_ts is not None:
+            state['last_ts']   = str(last_ts)
+            state['last_band'] = ALL_BANDS[last_code]
+        else:
+            state['last_ts']   = None
+            state['last_band'] = None
+        files[fname]=state
+        total += nspots
+        add_time('read',time.perf_counter()-t0)
+        count('read',nspots)
+
+    return total
+
+
+# Function to read the challenge data
+def load_challenge_data(fname):
+    from dx.spot_processing import ChallengeData
+    logger.info('Reading challenge data %s ...',fname)
+    with timer('challenge'):
+        chdata = ChallengeData(fname)
+    return chdata
+
+
+# Function to load spots from ALL.TXT file.  resolver is the DxccResolver
+# that fills in the DXCC info & need flags.  progress(builder,done,total) is
+# called as we go along with the spots so far & number of bytes read.  If
+# export is set, the needed spots we read are written to NEEDED_FILE -
+# appended if we're carrying on from the cache or from scratch if not.
+# Spots that were exported while following the logs last time are skipped.
+def load_spots(states_file,resolver,progress=None,export=False):
+
+    fnames = log_files()
+    cutoff = datetime.utcnow() - timedelta(days=MAX_DAYS)
+
+    # Start with what we read last time - only need to read what has been added since
+    print('Reading spot cache ...')
+    spots,files,grids = load_cache(CACHE_FILE,states_file)
+    if spots is None or not check_log_files(fnames,files):
+        print('Reading all spot data from scratch ...')
+        spots = SpotStore.empty()
+        files = {}
+    else:
+        spots = spots.since(cutoff)
+        resolver.grids.update(grids)
+        print('... Read',len(spots),'spots from cache')
+
+    # Figure out what we need to read from each file.  If there is a lot,
+    # farm it out to a pool of processes.  We may have threads going by now,
+    # e.g. the gui's, so the processes are started fresh rather than forked.
+    todo,nbytes = find_new_data(fnames,files)
+    if nbytes>CHUNK_SIZE:
+        print('Reading',nbytes,'bytes using',NUM_WORKERS,'processes ...')
+        pool = ProcessPoolExecutor(max_workers=NUM_WORKERS,
+                                   mp_context=multiprocessing.get_context(MP_START))
+    else:
+        pool = None
+
+    builder = SpotBuilder()
+    builder.append(spots)
+    del spots
+    if progress:
+        progress(builder,0,nbytes)
+    if export:
+        needed = []
+        append = len(files)>0
+        if append:
+            exported = load_exported()
+        else:
+            exported = {}
+    else:
+        needed   = None
+        exported = {}
+    read_new_spots(todo,files,cutoff,resolver,builder,pool,progress,needed,exported)
+    if pool:
+        pool.shutdown()
+    if export:
+        export_needed(needed,append)
+        save_exported(files)
+        needed = None
+
+    # Save the columnar store for next time.  The need flags of the cached
+    # spots are worked out again in case the challenge data has changed.
+    spots = builder.finish()
+    with timer('needs'):
+        spots.needs = resolver.need_table(spots.countries)
+    print('size=',spots.nbytes(),'bytes for',len(spots),'spots')
+    resolver.print_stats()
 
     if len(spots)>0:
-        #print 'First spot:',spots[0]
-        #print 'Last  spot:',spots[-1]
+        #print 'First spot:',spots.spot(0)
+        #print 'Last  spot:',spots.spot(-1)
         pass
     else:
         print('No spots loaded')
 
-    #print( '-%s- -%s-\n',(date,spots[-1]['date']) )
-
-    if False:
-        print('Saving spot data...')
-        fp = open('spots.pcl','wb')
-        pickle.dump( spots,fp )
-        fp.close()
-        print('... Saved spot data.')
-
-    return spots
-
-
-# Function to generate list of DXCCs seen in list of spots
-def count_dxccs(spot_list):
-    dxccs = list(set( [x['country'] for x in spot_list] ))
-    return dxccs
-    
-
-# Function to select spots based on band, date, "need", etc.
-def filter_spots(spots,date1=None,date2=None,band=None,Need=None):
-    
-    print('\nSelecting spots ...',date1,date2,band,Need)
-    if not band:
-        bands=BANDS
-    else:
-        bands=[band]
-        
-    if not date1:
-        date1 = spots[0]['TimeStamp']
+    print('Saving spot cache...')
+    save_cache(CACHE_FILE,spots,files,states_file,resolver.grids)
+    print('... Saved spot cache.')
+
+    return spots,files
+
+
+# Function to read any spots added to the log files since we last looked.
+# Spots older than MAX_DAYS are dropped as we go so the store doesn't keep
+# growing when we follow the logs for a long time.  If export is set, new
+# needed spots are appended to NEEDED_FILE.  Returns the updated store and
+# the new spots.
+def tail_spots(spots,files,resolver,export=False):
+
+    todo,nbytes = find_new_data(log_files(),files)
+    for fname in list(todo.keys()):
+        state,old = todo[fname]
+        if file_replaced(state,old):
+            print('Log file',fname,'has been replaced - restart to reload it')
+            del todo[fname]
+    if len(todo)==0:
+        return spots,None
+
+    cutoff  = datetime.utcnow() - timedelta(days=MAX_DAYS)
+    builder = SpotBuilder()
+    if export:
+        needed   = []
+        exported = load_exported()
     else:
-        date1 = date1.replace(tzinfo=pytz.utc)
-    if not date2:
-        date2 = spots[-1]['TimeStamp']
+        needed   = None
+        exported = {}
+    nspots = read_new_spots(todo,files,cutoff,resolver,builder,None,None,needed,exported)
+    if nspots==0:
+        return spots,None
+    if export:
+        export_needed(needed)
+        save_exported(files)
+    new_spots = builder.finish()
+    spots = spots.since(cutoff).merge(new_spots)
+    return spots,new_spots
+
+
+# Function to read how far into each log file the needed spots have been
+# exported - nothing if there isn't a file of them to add to
+def load_exported(fname=EXPORTED_FILE):
+    if not os.path.exists(NEEDED_FILE):
+        return {}
+    try:
+        with open(fname,'r') as fp:
+            return json.load(fp)
+    except (OSError,ValueError):
+        return {}
+
+# Function to save how far into each log file we've read, and so exported
+def save_exported(files,fname=EXPORTED_FILE):
+    with open(fname,'w') as fp:
+        json.dump({f:state['offset'] for f,state in files.items()},fp)
+
+
+# Function to export the needed spots in a list of stores to a csv file.
+# They are appended to it unless append is False.
+def export_needed(batches,append=True,fname=NEEDED_FILE,Need=NEEDED_FLAG):
+
+    # Format everything at once and write it out in one go
+    rows=[]
+    for spots in batches:
+        spots = spots.take( spots.needed(Need) )
+        ts    = np.datetime_as_string(spots.ts,unit='s')
+        dates = [t[0:10] for t in ts]
+        times = [t[11:19] for t in ts]
+        bands = [ALL_BANDS[b] for b in spots.band]
+        calls = [spots.calls[c] for c in spots.call]
+        dxccs = [spots.countries[c] for c in spots.country]
+        rows += ['%s,%s,%s,%s,%s,%d\n' % row for row in
+                 zip(dates,times,bands,calls,dxccs,spots.snr.tolist())]
+    print('Exporting',len(rows),'needed spots to',fname,'...')
+
+    if append:
+        mode='a'
     else:
-        date2 = date2.replace(tzinfo=pytz.utc)
+        mode='w'
+    with open(fname,mode) as fp:
+        fp.writelines(rows)
 
-    if Need=='ALL SPOTS':
-        spots2 =[x for x in spots if x["TimeStamp"] >= date1 and \
-                 x["TimeStamp"] < date2 and x['band'] in bands ]
-    else:
-        spots2 =[x for x in spots if x["TimeStamp"] >= date1 and \
-                 x["TimeStamp"] < date2 and x['band'] in bands and \
-                 x[Need] ]
-        #print("I don't know what I am doing here!")
 
-    return spots2
-        
+# Function to convert a date on the command line
+def parse_date(txt):
+    for fmt in ['%Y%m%d_%H%M','%Y%m%d']:
+        try:
+            return datetime.strptime(txt,fmt)
+        except ValueError:
+            pass
+    print('Unable to parse date',txt,'- use YYYYMMDD or YYYYMMDD_HHMM')
+    sys.exit(1)
+
 
 ############################################################################################
 
@@ -682,26 +1164,123 @@ if __name__ == "__main__":
     print('\n****************************************************************************')
     print('\n   WS Mapper beginning ...\n')
 
-    pr = cProfile.Profile()
+    # Process command line args
+    arg_proc = argparse.ArgumentParser(description='Weak Signal Spot Mapper')
+    arg_proc.add_argument('-nocsv', action='store_true',
+                          help='Don\'t export needed spots to '+NEEDED_FILE)
+    arg_proc.add_argument('-follow', action='store_true',
+                          help='Keep reading new spots as they are decoded')
+    arg_proc.add_argument('-summary', nargs='?', const='-', default=None,
+                          help='Summarize needed spots on stdout or append to a file')
+    arg_proc.add_argument('-render', type=str, default=None,
+                          help='Render maps without the gui to a directory of PNGs or a .gif/.mp4 file')
+    arg_proc.add_argument('-start', type=str, default=None,
+                          help='Start of rendered maps - YYYYMMDD or YYYYMMDD_HHMM (UTC)')
+    arg_proc.add_argument('-stop', type=str, default=None,
+                          help='End of rendered maps - YYYYMMDD or YYYYMMDD_HHMM (UTC)')
+    arg_proc.add_argument('-step', type=int, default=1,
+                          help='Time step for rendered maps (hours)')
+    arg_proc.add_argument('-bands', nargs='+', choices=BANDS, default=BANDS,
+                          help='Bands to render')
+    arg_proc.add_argument('-need', type=str, default='ALL SPOTS',
+                          choices=['ALL SPOTS','New DXCCs','New Slots','DXCC 2021'],
+                          help='Spots to render')
+    arg_proc.add_argument('-serve', type=int, nargs='?', const=QUERY_PORT, default=None,
+                          help='Serve spot queries over http on this port without the gui')
+    arg_proc.add_argument('-density', action='store_true',
+                          help='Render the number of spots in each grid square')
+    arg_proc.add_argument('-fps', type=float, default=4,
+                          help='Frames per second for rendered animations')
+    arg_proc.add_argument('-log', type=str, default='INFO', choices=LEVELS,
+                          help='Logging level')
+    arg_proc.add_argument('-logfile', type=str, default=None,
+                          help='Log to a file instead of the terminal')
+    arg_proc.add_argument('-profile', type=str, default=None,
+                          choices=['cprofile','pyinstrument'],
+                          help='Profile the run')
+    arg_proc.add_argument('-memory', action='store_true',
+                          help='Track memory allocations')
+    args = arg_proc.parse_args()
+
+    setup_logging(args.log,args.logfile)
+    if args.memory:
+        start_memory()
 
     SETTINGS,RCFILE = read_settings('.keyerrc')
     MY_CALL = SETTINGS['MY_CALL']
     print('MY_CALL=',MY_CALL)
     fname=os.path.expanduser('~/'+MY_CALL+'/states.xls')
     print('fname=',fname)
-    chdata = ChallengeData(fname)
     #sys.exit(0)
-    
-    pr.enable()
-    spots  = load_spots()
-    pr.disable()
-    pr.print_stats(sort='time')
-    #sys.exit(0)
-    
+
+    if args.profile:
+        start_profile(args.profile)
+
+    # Render frames & quit if we're running headless
+    if args.render:
+        from batch_render import render_frames
+        resolver = DxccResolver(load_challenge_data(fname))
+        spots,files = load_spots(fname,resolver,export=not args.nocsv)
+        report()
+        memory_snapshot('after loading spots')
+
+        if args.stop:
+            date2 = parse_date(args.stop)
+        elif len(spots)==0:
+            print('No spots to render - use -stop to pick the frames anyway')
+            sys.exit(1)
+        else:
+            date2 = spots.ts[-1].astype(datetime).replace(minute=0,second=0) + timedelta(hours=1)
+        if args.start:
+            date1 = parse_date(args.start)
+        else:
+            date1 = date2 - timedelta(days=1)
+        if args.density:
+            mode = DENSITY
+        else:
+            mode = SPOTS
+        render_frames(spots,date1,date2,args.step,args.need,args.render,args.bands,
+                      fps=args.fps,nworkers=NUM_WORKERS,mode=mode)
+        stop_profile()
+        sys.exit(0)
+
+    # Serve queries & quit if we're running headless
+    if args.serve:
+        from spot_query import SpotQuery, serve
+        resolver = DxccResolver(load_challenge_data(fname))
+        spots,files = load_spots(fname,resolver,export=not args.nocsv)
+        report()
+        memory_snapshot('after loading spots')
+
+        query = SpotQuery(spots)
+        def poll():
+            global spots
+            spots,new_spots = tail_spots(spots,files,resolver,not args.nocsv)
+            if new_spots is None:
+                return None
+            logger.info('Read %d new spots',len(new_spots))
+            return spots
+        serve(query,port=args.serve,poll=poll if args.follow else None,poll_secs=POLL_SECS)
+        report()
+        stop_profile()
+        sys.exit(0)
+
     app  = QApplication(sys.argv)
-    gui  = WSMAP_GUI(spots)
-    
+    if args.summary=='-':
+        summary = sys.stdout
+    elif args.summary:
+        summary = open(args.summary,'a')
+    else:
+        summary = None
+ 
+    # Put up the gui right away & load the spots in the background
+    gui  = WSMAP_GUI(SpotStore.empty(),summary)
     date = gui.date_changed()
+    gui.load(fname,args.follow,not args.nocsv)
  
-    sys.exit(app.exec_())
+    rc = app.exec_()
+    report()
+    memory_snapshot('at exit')
+    stop_profile()
+    sys.exit(rc)
     